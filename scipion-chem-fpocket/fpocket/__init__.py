@@ -24,9 +24,11 @@
 # *
 # **************************************************************************
 
-import pwem
-from os.path import join, exists, abspath
+import pwem, os, shutil, tempfile
+from os.path import join, exists, abspath, expanduser
 from .constants import *
+from .utils import ResultsCache, makeScratchDir, moveResults
+from .jobs import Job, JobRunner
 
 _version_ = '0.1'
 _logo = "fpocket_logo.png"
@@ -44,6 +46,11 @@ class Plugin(pwem.Plugin):
         """ Return and write a variable in the config file.
         """
         cls._defineEmVar(FPOCKET_HOME, FPOCKET + '-' + FPOCKET_DEFAULT_VERSION)
+        cls._defineVar(FPOCKET_CACHE, join(expanduser('~'), '.cache', 'scipion-chem-fpocket'))
+        cls._defineVar(FPOCKET_CACHE_SIZE, '20')
+        cls._defineVar(FPOCKET_SCRATCH, tempfile.gettempdir())
+        cls._defineVar(FPOCKET_MAX_JOBS, str(os.cpu_count() or 1))
+        cls._defineVar(FPOCKET_JOB_MEMORY, '0')
 
     @classmethod
     def defineBinaries(cls, env):
@@ -65,36 +72,66 @@ class Plugin(pwem.Plugin):
     @classmethod
     def runFpocket(cls, protocol, program, args, cwd=None):
         """ Run Fpocket command from a given protocol. """
-        protocol.runJob(join(cls._pluginHome, 'bin/{}'.format(program)), args, cwd=cwd)
+        cls.runFpocketJobs(protocol, program, [(args, cwd)])
 
     @classmethod
-    def runMDpocket(cls, protocol, program, args, cwd=None):
-        """ Run MDpocket command from a given protocol. """
-        chg = 'mkdir {}/run_{} && cd {}/run_{} && {}'.\
-            format(join(cls._pluginHome, 'bin'), protocol.getObjId(), join(cls._pluginHome, 'bin'), protocol.getObjId(),
-                   program)
-        print(args)
-        protocol.runJob(chg, args, cwd=cwd)
-        cmd = 'cd {}/run_{} && mv ./* {} && rm -r {}/run_{}'.format(join(cls._pluginHome, 'bin'), protocol.getObjId(),
-                                                                    abspath(cwd),
-                                                                    join(cls._pluginHome, 'bin'), protocol.getObjId())
-
-        protocol.runJob(cmd, '', cwd=cwd)
+    def runFpocketJobs(cls, protocol, program, jobsArgs, maxJobs=None, onDone=None):
+        """ Run several Fpocket commands at once, given a list of (args, cwd).
+        If onDone is given, it is called as onDone(i, error) when the i-th command finishes and failures do not
+        raise (see JobRunner.run) """
+        jobs = [Job(join(cls._pluginHome, 'bin', program), args, cwd=cwd, name=None if len(jobsArgs) == 1 else i + 1)
+                for i, (args, cwd) in enumerate(jobsArgs)]
+        jobIdxs = {id(job): i for i, job in enumerate(jobs)}
+        cls.runJobs(protocol, jobs, maxJobs=maxJobs,
+                    onDone=(lambda job, error: onDone(jobIdxs[id(job)], error)) if onDone else None)
 
     @classmethod
-    def runSelIsovalue(cls, protocol, program, args, cwd=None):
-        cmd = 'python {}/{}'.format(join(cls._pluginHome, 'scripts'), program)
-        protocol.runJob(cmd, args, cwd=cwd)
+    def runMDpocket(cls, protocol, program, args, cwd=None, monitor=None):
+        """ Run MDpocket command from a given protocol. The command runs in its own scratch directory, inside
+        FPOCKET_SCRATCH, and its results are then moved into cwd, so concurrent runs never share a folder.
+        The progress of the run can be followed with a ProgressMonitor. """
+        cls.runMDpocketJobs(protocol, program, [(args, cwd)], monitors=[monitor])
+
+    @classmethod
+    def runMDpocketJobs(cls, protocol, program, jobsArgs, maxJobs=None, monitors=None):
+        """ Run several MDpocket commands at once, given a list of (args, cwd), each one in its scratch directory. """
+        monitors = monitors if monitors is not None else [None] * len(jobsArgs)
+        outDirs = [abspath(cwd if cwd is not None else protocol._getExtraPath()) for _, cwd in jobsArgs]
+        scratchDirs = [makeScratchDir(cls.getVar(FPOCKET_SCRATCH), 'mdpocket_{}_'.format(protocol.getObjId()))
+                       for _ in jobsArgs]
+        try:
+            cls.runJobs(protocol, [Job(program, args, cwd=scratchDir, name=None if len(jobsArgs) == 1 else i + 1,
+                                       monitor=monitor)
+                                   for i, ((args, _), scratchDir, monitor) in
+                                   enumerate(zip(jobsArgs, scratchDirs, monitors))], maxJobs=maxJobs)
+            for scratchDir, outDir in zip(scratchDirs, outDirs):
+                moveResults(scratchDir, outDir)
+        finally:
+            for scratchDir in scratchDirs:
+                shutil.rmtree(scratchDir, ignore_errors=True)
 
 
     @classmethod
     def runMDpocket_2(cls, protocol, program, args, cwd=None ):
-        protocol.runJob(program, args, cwd=cwd)
+        cls.runMDpocket(protocol, program, args, cwd=cwd)
+
+    @classmethod
+    def runJobs(cls, protocol, jobs, maxJobs=None, onDone=None):
+        """ Runs the jobs (no shell) concurrently. At most FPOCKET_MAX_JOBS programs run at the same time in the
+        process (and maxJobs of these jobs), each one limited to FPOCKET_JOB_MEMORY GB. Their output is streamed to
+        the protocol log. """
+        runner = JobRunner(int(cls.getVar(FPOCKET_MAX_JOBS)), float(cls.getVar(FPOCKET_JOB_MEMORY)) * 1024 ** 3)
+        runner.run(jobs, maxJobs=maxJobs, onDone=onDone)
 
     @classmethod  #  Test that
     def getEnviron(cls):
         pass
 
+    @classmethod
+    def getResultsCache(cls):
+        """ Cache of fpocket/mdpocket results, located in FPOCKET_CACHE and bounded to FPOCKET_CACHE_SIZE GB """
+        return ResultsCache(cls.getVar(FPOCKET_CACHE), float(cls.getVar(FPOCKET_CACHE_SIZE)) * 1024 ** 3)
+
 
     # ---------------------------------- Utils functions  -----------------------
 
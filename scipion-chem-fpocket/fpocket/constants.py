@@ -26,6 +26,11 @@
 
 
 FPOCKET_HOME = 'FPOCKET_HOME'
+FPOCKET_CACHE = 'FPOCKET_CACHE'
+FPOCKET_CACHE_SIZE = 'FPOCKET_CACHE_SIZE'  # GB
+FPOCKET_SCRATCH = 'FPOCKET_SCRATCH'
+FPOCKET_MAX_JOBS = 'FPOCKET_MAX_JOBS'
+FPOCKET_JOB_MEMORY = 'FPOCKET_JOB_MEMORY'  # GB, 0 for no limit
 
 # Supported Versions
 V3_0 = '3.0'
@@ -41,3 +46,31 @@ DIST_TYPES = ['Euclidean', 'Manhattan']
 DIST_TYPES_CODES = ['e', 'b']
 
 
+
+# Descriptor columns of mdpocket's mdpout_descriptors.txt (same order as the viewer labels)
+MDPOCKET_DESCRIPTORS = ['pock_volume', 'pock_asa', 'pock_pol_asa', 'pock_apol_asa', 'pock_asa22', 'pock_pol_asa22',
+                        'pock_apol_asa22', 'nb_AS', 'mean_as_ray', 'mean_as_solv_acc', 'apol_as_prop',
+                        'mean_loc_hyd_dens', 'hydrophobicity_score', 'volume_score', 'polarity_score',
+                        'charge_score', 'prop_polar_atm', 'as_density', 'as_max_dst']
+
+# Statistics of each descriptor stored in the characterized pockets (as _<descriptor>_<statistic> attributes)
+DESCRIPTOR_STATS = ['mean', 'std', 'p5', 'p25', 'median', 'p75', 'p95', 'acTime']
+
+# Longer descriptor series are plotted reduced to this number of bins (min/max envelope)
+DESCRIPTOR_PLOT_BINS = 2000
+
+# Downsampling factors of the stored grid pyramid (resolution levels of the volumetric viewer)
+GRID_PYRAMID_FACTORS = [2, 4]
+GRID_RESOLUTIONS = ['Coarse (4x)', 'Medium (2x)', 'Full']
+GRID_RESOLUTION_FACTORS = [4, 2, 1]
+
+CHARAC_MODES = ['Per pocket', 'Single pass']
+# Descriptors computed in single pass mode (from the alpha sphere centers alone)
+SINGLE_PASS_DESCRIPTORS = ['nb_AS', 'as_density', 'as_max_dst']
+# Max distance (A) from a pocket point to assign it an alpha sphere center / receptor atom in single pass mode
+# (each one goes to the pocket with the closest point)
+SPHERE_ASSIGN_DIST = 3.0
+ATOM_ASSIGN_DIST = 6.0
+
+# Max distance (A) between a pocket point and a receptor atom to consider them in contact
+CONTACT_DIST = 4.0
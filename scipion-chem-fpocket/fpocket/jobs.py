@@ -0,0 +1,242 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *           Lobna Ramadane Morchadi (lobna.ramadane@alumnos.upm.es)
+# * Biocomputing Unit, CNB-CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Asynchronous runner of the fpocket/mdpocket programs
+"""
+
+import asyncio, subprocess, threading, re, time, json
+
+try:
+    import resource
+except ImportError:
+    #Memory budgets are only available in Unix systems
+    resource = None
+
+
+class Job:
+    """ An external program to run: program path, list of arguments and working directory.
+    An optional monitor (see ProgressMonitor) receives the output lines of the program while it runs """
+    def __init__(self, program, args, cwd=None, name=None, monitor=None):
+        self.program, self.args, self.cwd = program, args, cwd
+        self.name, self.monitor = name, monitor
+
+    def getCommand(self):
+        return [str(self.program)] + [str(arg) for arg in self.args]
+
+
+class JobRunner:
+    """
+    Runs jobs without a shell on an asyncio event loop, so any number of them can be submitted at once.
+    The number of programs running at the same time in the whole process is bounded by maxJobs, and the address
+    space of each of them by memLimit (bytes, 0 for no limit). Their output is streamed line by line to log.
+    """
+    _slots = {}
+    _slotsLock = threading.Lock()
+
+    def __init__(self, maxJobs, memLimit=0, log=None):
+        self.memLimit = int(memLimit)
+        self.log = log if log is not None else lambda line: print(line, flush=True)
+        maxJobs = max(int(maxJobs), 1)
+        with JobRunner._slotsLock:
+            #Process wide slots, shared by the runners of every thread (parallel steps) with the same maxJobs. If the
+            # limit changes, runners created afterwards use new slots with the new limit
+            if maxJobs not in JobRunner._slots:
+                JobRunner._slots[maxJobs] = threading.BoundedSemaphore(maxJobs)
+            self.slots = JobRunner._slots[maxJobs]
+
+    def run(self, jobs, maxJobs=None, onDone=None):
+        """ Runs the jobs, at most maxJobs of them at the same time, and waits for all of them.
+        Raises CalledProcessError for the first failed job, once all of them have finished.
+        If onDone is given, it is called as onDone(job, error) as soon as each job finishes (error is None if the job
+        succeeded) and the failed jobs are only reported to it """
+        if jobs:
+            asyncio.run(self._runAll(list(jobs), maxJobs, onDone))
+
+    async def _runAll(self, jobs, maxJobs, onDone=None):
+        localSlots = asyncio.Semaphore(maxJobs if maxJobs else len(jobs))
+        runJob = self._runJob if onDone is None else lambda job, slots: self._runAndNotify(job, slots, onDone)
+        results = await asyncio.gather(*[runJob(job, localSlots) for job in jobs], return_exceptions=True)
+        errors = [res for res in results if isinstance(res, BaseException)]
+        if errors:
+            raise errors[0]
+
+    async def _runAndNotify(self, job, localSlots, onDone):
+        error = None
+        try:
+            await self._runJob(job, localSlots)
+        except Exception as e:
+            error = e
+        onDone(job, error)
+
+    async def _runJob(self, job, localSlots):
+        cmd = job.getCommand()
+        prefix = '[{}] '.format(job.name) if job.name else ''
+        async with localSlots:
+            await asyncio.get_running_loop().run_in_executor(None, self.slots.acquire)
+            sampler = None
+            try:
+                self.log('{}{}'.format(prefix, ' '.join(cmd)))
+                proc = await asyncio.create_subprocess_exec(*cmd, cwd=job.cwd, stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE)
+                self._limitMemory(proc.pid)
+                if job.monitor:
+                    job.monitor.start(proc.pid, log=lambda line: self.log(prefix + line))
+                    sampler = asyncio.ensure_future(self._sample(job.monitor))
+                await asyncio.gather(self._stream(proc.stdout, prefix, job.monitor),
+                                     self._stream(proc.stderr, prefix, job.monitor))
+                returnCode = await proc.wait()
+            finally:
+                self.slots.release()
+                if sampler is not None:
+                    sampler.cancel()
+                    job.monitor.finish()
+
+        if returnCode != 0:
+            raise subprocess.CalledProcessError(returnCode, cmd)
+        return returnCode
+
+    async def _stream(self, stream, prefix, monitor=None):
+        # Lines are split on carriage returns too, as progress counters rewrite the same terminal line
+        pending = ''
+        while True:
+            data = await stream.read(2 ** 16)
+            if not data:
+                break
+            lines = re.split('[\r\n]', pending + data.decode(errors='replace'))
+            pending = lines.pop()
+            for line in lines:
+                self._processLine(line, prefix, monitor)
+        if pending:
+            self._processLine(pending, prefix, monitor)
+
+    def _processLine(self, line, prefix, monitor):
+        if monitor is None or not monitor.update(line):
+            if line.strip():
+                self.log(prefix + line)
+
+    async def _sample(self, monitor):
+        while True:
+            await asyncio.sleep(monitor.sampleInterval)
+            monitor.sample()
+
+    def _limitMemory(self, pid):
+        # Set on the running process (prlimit) instead of a preexec_fn, which is not safe with threads
+        if self.memLimit > 0 and resource is not None and hasattr(resource, 'prlimit'):
+            try:
+                resource.prlimit(pid, resource.RLIMIT_AS, (self.memLimit, self.memLimit))
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+class ProgressMonitor:
+    """
+    Follows the progress of a program that reports the frames (snapshots) it processes. Logs the frames done,
+    frames/s, ETA and peak resident memory of the process every logInterval seconds and keeps their timeline,
+    which is written as JSON in timelineFile. The timeline keeps at most maxTimeline points: when full, every other
+    point is dropped and the interval between points doubled.
+    """
+    FRAME_RE = re.compile(r'snapshot\D*?(\d+)', re.IGNORECASE)
+
+    def __init__(self, totalFrames=None, timelineFile=None, logInterval=10, sampleInterval=1, maxTimeline=1000):
+        self.totalFrames, self.timelineFile = totalFrames, timelineFile
+        self.logInterval, self.sampleInterval = logInterval, sampleInterval
+        self.timelineInterval, self.maxTimeline = logInterval, maxTimeline
+        self.pid, self.log = None, print
+        self.startTime, self.lastLog, self.lastPoint = None, 0, 0
+        self.framesDone, self.peakRss, self.timeline = 0, 0, []
+
+    def start(self, pid, log=None):
+        self.pid, self.startTime = pid, time.time()
+        self.log = log if log is not None else self.log
+
+    def update(self, line):
+        """ Parses an output line. Returns whether it was a progress line """
+        match = self.FRAME_RE.search(line)
+        if not match:
+            return False
+        self.framesDone = max(self.framesDone, int(match.group(1)))
+        return True
+
+    def sample(self):
+        """ Updates the peak memory (called every sampleInterval seconds while the program runs), logging the progress
+        and adding it to the timeline when their intervals have passed """
+        self.peakRss = max(self.peakRss, self.readPeakRss())
+        stats = self.getStats()
+        if stats['elapsed'] - self.lastPoint >= self.timelineInterval:
+            self.lastPoint = stats['elapsed']
+            self.addTimelinePoint(stats)
+        if stats['elapsed'] - self.lastLog >= self.logInterval:
+            self.lastLog = stats['elapsed']
+            self.log(self.formatStats(stats))
+
+    def addTimelinePoint(self, stats):
+        self.timeline.append(stats)
+        if len(self.timeline) > self.maxTimeline:
+            self.timeline = self.timeline[::2]
+            self.timelineInterval *= 2
+
+    def finish(self):
+        stats = self.getStats()
+        self.addTimelinePoint(stats)
+        self.log(self.formatStats(stats))
+        if self.timelineFile:
+            with open(self.timelineFile, 'w') as f:
+                json.dump({'summary': stats, 'timeline': self.timeline}, f, indent=1)
+
+    def getStats(self):
+        elapsed = time.time() - self.startTime
+        fps = self.framesDone / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.totalFrames and fps > 0:
+            eta = max(self.totalFrames - self.framesDone, 0) / fps
+        return {'elapsed': round(elapsed, 3), 'framesDone': self.framesDone, 'totalFrames': self.totalFrames,
+                'framesPerSecond': round(fps, 3), 'eta': None if eta is None else round(eta, 1),
+                'peakRssMB': round(self.peakRss / 1024 ** 2, 1)}
+
+    def readPeakRss(self):
+        """ Peak resident memory (bytes) of the process, from /proc (0 if not available) """
+        try:
+            with open('/proc/{}/status'.format(self.pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return 0
+
+    @staticmethod
+    def formatStats(stats):
+        total = '/{}'.format(stats['totalFrames']) if stats['totalFrames'] else ''
+        eta = ' | ETA {}'.format(formatSeconds(stats['eta'])) if stats['eta'] is not None else ''
+        return 'Frames {}{} | {:.2f} frames/s{} | peak RSS {:.1f} MB'.\
+            format(stats['framesDone'], total, stats['framesPerSecond'], eta, stats['peakRssMB'])
+
+
+def formatSeconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h {:02d}m {:02d}s'.format(hours, minutes, seconds) if hours else '{}m {:02d}s'.format(minutes, seconds)
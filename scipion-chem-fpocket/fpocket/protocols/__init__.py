@@ -5,6 +5,7 @@
 # **************************************************************************
 
 from .protocol_fpocket import FpocketFindPockets
+from .protocol_fpocket_batch import FpocketBatchFindPockets
 from .protocol_mdpocket_findPockets import MDpocketAnalyze
 from .protocol_mdpocket_characterizePockets import MDpocketCharacterize
 
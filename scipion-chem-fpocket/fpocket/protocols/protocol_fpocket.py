@@ -43,6 +43,7 @@ from pwchem.utils import clean_PDB
 
 from fpocket import Plugin
 from fpocket.constants import *
+from fpocket.utils import hashFile, hashKey, StepProfiler
 
 class FpocketFindPockets(EMProtocol):
     """
@@ -60,6 +61,9 @@ class FpocketFindPockets(EMProtocol):
                        label="Input atom structure",
                        help='Select the atom structure to search for pockets')
 
+        self._defineDetectionParams(form)
+
+    def _defineDetectionParams(self, form):
         form.addSection(label='Pocket detection parameters')
         group = form.addGroup('Alpha spheres')
         group.addParam('minAlpha', params.FloatParam, default=3.4,
@@ -90,10 +94,19 @@ class FpocketFindPockets(EMProtocol):
         form.addParam('mcIterVol', params.IntParam, default=300, expertLevel=params.LEVEL_ADVANCED,
                        label='Monte-Carlo iterations for volume',
                        help='Number of Monte-Carlo iteration for the calculation of each pocket volume.')
+        form.addParam('useCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Reuse cached results: ',
+                       help='Reuse the fpocket results of previous runs with the same input structure and parameters, '
+                            'stored in the FPOCKET_CACHE folder (bounded to FPOCKET_CACHE_SIZE GB)')
+        form.addParam('profileSteps', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label='Profile steps: ',
+                       help='Record the wall time, CPU time, peak memory and bytes read/written of each step '
+                            '(input conversion, fpocket run, output) in the profile.json file of the protocol folder')
 
 
-    def _getFpocketArgs(self):
-        args = ['-f', os.path.abspath(self.inpFile)]
+    def _getFpocketArgs(self, inpFile=None):
+        inpFile = self.inpFile if inpFile is None else inpFile
+        args = ['-f', os.path.abspath(inpFile)]
 
         #Alpha spheres
         args += ['-m', self.minAlpha.get(), '-M', self.maxAlpha.get(), '-i', self.minNSpheres.get(),
@@ -116,48 +129,34 @@ class FpocketFindPockets(EMProtocol):
 
     def convertInputStep(self):
         #Simply copying the input struct file into current extra file (fpocket will create output there automatically)
-        inpStruct = self.inputAtomStruct.get()
-        inpFile = self.getPdbInputStruct()
-        inpName = self.getPdbInputStructName()
-        self.inpBase, self.ext = os.path.splitext(inpName)
-        if self.ext == '.ent':
-            self.inpFile = self._getExtraPath(self.inpBase+'.pdb')
-            shutil.copy(inpFile, self.inpFile)
-        elif self.ext == '.cif':
-            self.inpFile = self._getExtraPath(self.inpBase + '.pdb')
-            clean_PDB(inpFile, self.inpFile)
-        elif str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
-            self.inpFile = self._getExtraPath(os.path.basename(inpFile).replace(inpStruct.getExtension(), '.pdb'))
-            inpStruct.convert2PDB(outPDB=self.inpFile)
-        else:
-            self.inpFile = self._getExtraPath(inpName)
-            shutil.copy(inpFile, self.inpFile)
+        with self.getProfiler().section('convert'):
+            self.inpFile = self.convertInputStruct(self.inputAtomStruct.get(), self._getExtraPath())
+            self.inpBase = os.path.splitext(os.path.basename(self.inpFile))[0]
 
     def fPocketStep(self):
-        Plugin.runFpocket(self, 'fpocket', args=self._getFpocketArgs(), cwd=self._getExtraPath())
+        with self.getProfiler().section('fpocket', kind='binary'):
+            self.runFpocketCached(self.inpFile)
 
     def createOutputStep(self):
-        pocketsDir = os.path.abspath(self._getExtraPath('{}/pockets'.format(self.inpBase+'_out')))
-        pocketFiles = os.listdir(pocketsDir)
+        profiler = self.getProfiler()
+        with profiler.section('pocket parsing'):
+            pockets = self.parsePockets(self.inpFile, self.inputAtomStruct.get())
 
-        inpStruct = self.inputAtomStruct.get()
-        outPockets = SetOfPockets(filename=self._getExtraPath('pockets.sqlite'))
-        for pFile in pocketFiles:
-            if '.pdb' in pFile:
-                pFileName = os.path.join(pocketsDir, pFile)
-                pqrFile = pFileName.replace('atm.pdb', 'vert.pqr')
-                pock = ProteinPocket(pqrFile, self.inpFile, pFileName, pClass='FPocket')
-                if str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
-                  pock._maeFile = String(os.path.abspath(inpStruct.getFileName()))
+        with profiler.section('sqlite output'):
+            outPockets = SetOfPockets(filename=self._getExtraPath('pockets.sqlite'))
+            for pock in pockets:
                 outPockets.append(pock)
 
-        outHETMFile = outPockets.buildPDBhetatmFile()
+        with profiler.section('pocket file writing'):
+            outHETMFile = outPockets.buildPDBhetatmFile()
         self._defineOutputs(**{self._possibleOutputs.outputPockets.name: outPockets})
 
-
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
+        profileSummary = self.getProfiler().getSummary()
+        if profileSummary:
+            summary.append(profileSummary)
         return summary
 
     def _methods(self):
@@ -181,6 +180,76 @@ class FpocketFindPockets(EMProtocol):
         return warnings
 
     # --------------------------- UTILS functions -----------------------------------
+    def convertInputStruct(self, inpStruct, outDir):
+        """ Converts (or copies) the input structure into a PDB file in outDir, where fpocket will write its output.
+        Returns the path to that file """
+        inpFile = inpStruct.getFileName()
+        inpName = os.path.basename(inpFile)
+        inpBase, ext = os.path.splitext(inpName)
+        if ext == '.ent':
+            outFile = os.path.join(outDir, inpBase + '.pdb')
+            shutil.copy(inpFile, outFile)
+        elif ext == '.cif':
+            outFile = os.path.join(outDir, inpBase + '.pdb')
+            clean_PDB(inpFile, outFile)
+        elif str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
+            outFile = os.path.join(outDir, inpName.replace(inpStruct.getExtension(), '.pdb'))
+            inpStruct.convert2PDB(outPDB=outFile)
+        else:
+            outFile = os.path.join(outDir, inpName)
+            shutil.copy(inpFile, outFile)
+        return outFile
+
+    def getProfiler(self):
+        return StepProfiler(self._getPath('profile.json'), enabled=self.profileSteps.get())
+
+    def getCacheKey(self, inpFile):
+        """ Key of the fpocket results: hash of the input structure and the arguments (without the input path) """
+        args = self._getFpocketArgs(inpFile)
+        args[1] = os.path.basename(inpFile)
+        return hashKey('fpocket', hashFile(inpFile), args)
+
+    def runFpocketCached(self, inpFile):
+        """ Runs fpocket on the input file, in its folder, unless the results are found in the cache """
+        if not self.restoreCachedResults(inpFile):
+            Plugin.runFpocket(self, 'fpocket', args=self._getFpocketArgs(inpFile),
+                              cwd=os.path.dirname(os.path.abspath(inpFile)))
+            self.storeCachedResults(inpFile)
+
+    def restoreCachedResults(self, inpFile):
+        """ Restores the fpocket results of the input file from the cache. Returns whether they were found """
+        if not self.useCache.get():
+            return False
+        cache, key = Plugin.getResultsCache(), self.getCacheKey(inpFile)
+        if cache.restore(key, os.path.dirname(os.path.abspath(inpFile))):
+            print('Fpocket results restored from cache ({})'.format(key))
+            return True
+        return False
+
+    def storeCachedResults(self, inpFile, evict=True):
+        if self.useCache.get():
+            Plugin.getResultsCache().store(self.getCacheKey(inpFile), [self.getResultsDir(inpFile)], evict=evict)
+
+    def getResultsDir(self, inpFile):
+        return os.path.join(os.path.dirname(os.path.abspath(inpFile)),
+                            '{}_out'.format(os.path.splitext(os.path.basename(inpFile))[0]))
+
+    def parsePockets(self, inpFile, inpStruct):
+        """ Returns the list of pockets found by fpocket for the (converted) input file """
+        inpBase = os.path.splitext(os.path.basename(inpFile))[0]
+        pocketsDir = os.path.abspath(os.path.join(os.path.dirname(inpFile), '{}_out/pockets'.format(inpBase)))
+
+        pockets = []
+        for pFile in os.listdir(pocketsDir):
+            if '.pdb' in pFile:
+                pFileName = os.path.join(pocketsDir, pFile)
+                pqrFile = pFileName.replace('atm.pdb', 'vert.pqr')
+                pock = ProteinPocket(pqrFile, inpFile, pFileName, pClass='FPocket')
+                if str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
+                  pock._maeFile = String(os.path.abspath(inpStruct.getFileName()))
+                pockets.append(pock)
+        return pockets
+
     def getPdbInputStruct(self):
         return self.inputAtomStruct.get().getFileName()
 
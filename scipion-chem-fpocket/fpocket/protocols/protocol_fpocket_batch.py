@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+
+
+"""
+This protocol is used to perform a pocket search on a set of protein structures using the FPocket software
+
+"""
+
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+
+from pwchem.objects import SetOfPockets
+
+from fpocket import Plugin
+from fpocket.protocols.protocol_fpocket import FpocketFindPockets
+
+class FpocketBatchFindPockets(FpocketFindPockets):
+    """
+    Executes the fpocket software to look for protein pockets in every structure of a set.
+    All the fpocket runs are submitted at once (as many running at the same time as threads) and all the pockets
+    are gathered in a single output set, as each run finishes. Structures that fail are skipped and listed in
+    skippedStructures.txt.
+    Unlike the single structure protocol, the structures are converted (with the same convertInputStruct) one after
+    the other before submitting the runs, and no combined PDB file with the pockets as HETATM (buildPDBhetatmFile)
+    is written, as the pockets belong to different structures.
+    """
+    _label = 'Find pockets (batch)'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ """
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputAtomStructs', params.PointerParam,
+                       pointerClass='SetOfAtomStructs', allowsNull=False,
+                       label="Input atom structures",
+                       help='Select the set of atom structures to search for pockets')
+
+        self._defineDetectionParams(form)
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        # Insert processing steps
+        self._insertFunctionStep('fPocketBatchStep')
+
+    def fPocketBatchStep(self):
+        # A structure failing its conversion, fpocket run or parsing is skipped (and logged), not the whole batch
+        profiler, skipped = self.getProfiler(), []
+        with profiler.section('convert'):
+            inpStructs, inpFiles = [], []
+            for inpStruct in self.inputAtomStructs.get():
+                inpStruct = inpStruct.clone()
+                try:
+                    inpFiles.append(self.convertStructInput(inpStruct))
+                    inpStructs.append(inpStruct)
+                except Exception as e:
+                    skipped.append((inpStruct, 'conversion failed: {}'.format(e)))
+
+        outPockets = SetOfPockets(filename=self._getPath('pockets.sqlite'))
+
+        def addPockets(inpStruct, inpFile):
+            #Nested in the fpocket section, but its time is only counted as pocket parsing
+            with profiler.section('pocket parsing'):
+                try:
+                    for pock in self.parsePockets(inpFile, inpStruct):
+                        outPockets.append(pock)
+                except Exception as e:
+                    skipped.append((inpStruct, 'parsing failed: {}'.format(e)))
+
+        #Every structure without cached results is run in a single submission and its pockets are added to the
+        # output as soon as its run finishes, while the rest are still running
+        with profiler.section('fpocket', kind='binary'):
+            pendingIdxs = []
+            for i, inpFile in enumerate(inpFiles):
+                if self.restoreCachedResults(inpFile):
+                    addPockets(inpStructs[i], inpFile)
+                else:
+                    pendingIdxs.append(i)
+
+            def onDone(i, error):
+                inpStruct, inpFile = inpStructs[pendingIdxs[i]], inpFiles[pendingIdxs[i]]
+                if error is not None:
+                    skipped.append((inpStruct, 'fpocket failed: {}'.format(error)))
+                    return
+                self.storeCachedResults(inpFile, evict=False)
+                addPockets(inpStruct, inpFile)
+
+            Plugin.runFpocketJobs(self, 'fpocket', [(self._getFpocketArgs(inpFiles[i]), os.path.dirname(inpFiles[i]))
+                                                    for i in pendingIdxs],
+                                  maxJobs=max(self.numberOfThreads.get(), 1), onDone=onDone)
+            if self.useCache.get() and pendingIdxs:
+                Plugin.getResultsCache().evict()
+
+        self.writeSkippedStructures(skipped)
+        if len(skipped) == len(self.inputAtomStructs.get()):
+            raise RuntimeError('Pockets could not be found in any structure (see {})'.format(self.getSkippedFile()))
+
+        self._defineOutputs(**{self._possibleOutputs.outputPockets.name: outPockets})
+        self._defineSourceRelation(self.inputAtomStructs, outPockets)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        if hasattr(self, 'outputPockets'):
+            summary.append('{} pockets found in {} structures'.format(len(self.outputPockets),
+                                                                     len(self.inputAtomStructs.get())))
+        skipped = self.readSkippedStructures()
+        if skipped:
+            summary.append('{} structures skipped (see {})'.format(len(skipped), self.getSkippedFile()))
+        profileSummary = self.getProfiler().getSummary()
+        if profileSummary:
+            summary.append(profileSummary)
+        return summary
+
+    def _validate(self):
+        errors = []
+        if len(self.inputAtomStructs.get()) == 0:
+            errors.append('The input set of atom structures is empty')
+        return errors
+
+    def _warnings(self):
+        return []
+
+    # --------------------------- UTILS functions -----------------------------------
+    def getSkippedFile(self):
+        return self._getPath('skippedStructures.txt')
+
+    def writeSkippedStructures(self, skipped):
+        """ Logs the skipped structures and lists them (id, file and reason, tab separated) in the skipped file """
+        with open(self.getSkippedFile(), 'w') as f:
+            for inpStruct, reason in skipped:
+                print('Structure {} ({}) skipped, {}'.format(inpStruct.getObjId(), inpStruct.getFileName(), reason))
+                f.write('{}\t{}\t{}\n'.format(inpStruct.getObjId(), inpStruct.getFileName(),
+                                               str(reason).replace('\n', ' ')))
+
+    def readSkippedStructures(self):
+        if not os.path.exists(self.getSkippedFile()):
+            return []
+        with open(self.getSkippedFile()) as f:
+            return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+    def convertStructInput(self, inpStruct):
+        """ Converts a structure into its own folder and returns the fpocket input file """
+        structDir = os.path.abspath(self._getExtraPath('structure_{}'.format(inpStruct.getObjId())))
+        os.makedirs(structDir, exist_ok=True)
+        return os.path.abspath(self.convertInputStruct(inpStruct, structDir))
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Lobna Ramadane Morchadi (lobna.ramadane@alumnos.upm.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+
+
+"""
+Base class of the mdpocket protocols, with the common preparation of the input trajectory
+
+"""
+
+import os
+
+from pyworkflow.protocol import params
+from pwem.protocols import EMProtocol
+
+from fpocket import Plugin
+from fpocket.utils import stageFiles, hashKey, readXtcFrameIndex, writeXtcFrames, hasMDAnalysis, writeAtomsSubset, \
+    StepProfiler
+
+class MDpocketBase(EMProtocol):
+    """
+    Base protocol for the mdpocket protocols. Stages the input system and trajectory (selecting the frames and atoms
+    to analyze) so mdpocket only processes the frames and atoms of interest.
+    """
+    _label = None
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineTrajectoryParams(self, form):
+        form.addSection(label='Trajectory')
+        group = form.addGroup('Frames')
+        group.addParam('firstFrame', params.IntParam, default=1,
+                       label='First frame: ',
+                       help='First frame of the trajectory to analyze (starting at 1)')
+        group.addParam('lastFrame', params.IntParam, default=-1,
+                       label='Last frame: ',
+                       help='Last frame of the trajectory to analyze (included). -1 for the last one')
+        group.addParam('frameStride', params.IntParam, default=1,
+                       label='Frame stride: ',
+                       help='Analyze one of every n frames. The selected frames are written once into a reduced '
+                            'trajectory (XTC only), which is also cached for later runs')
+
+        group = form.addGroup('Atoms')
+        group.addParam('stripSolvent', params.BooleanParam, default=False,
+                       label='Strip solvent and ions: ',
+                       help='Write a topology and trajectory with only the selected atoms (by default, the protein) '
+                            'and analyze them instead of the full system. Water and ions are often most of the atoms '
+                            'of the system, so this reduces the trajectory reading time of mdpocket accordingly.\n'
+                            'Requires MDAnalysis.')
+        group.addParam('atomSelection', params.StringParam, default='protein', condition='stripSolvent',
+                       label='Atoms to keep: ',
+                       help='Selection of the atoms to keep, in MDAnalysis syntax. '
+                            'e.g: "protein", "protein or resname LIG", "not resname SOL NA CL"')
+
+        form.addParam('useCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse cached results: ',
+                      help='Reuse the intermediate results (reduced trajectories, mdpocket grids) of previous runs '
+                           'with the same inputs and parameters, stored in the FPOCKET_CACHE folder. For example, '
+                           'changing only the isovalues or the clustering distance skips the trajectory analysis.')
+        form.addParam('profileSteps', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                      label='Profile steps: ',
+                      help='Record the wall time, CPU time, peak memory and bytes read/written of each step '
+                           '(input conversion, mdpocket runs, post-processing) in the profile.json file of the '
+                           'protocol folder')
+
+    # --------------------------- STEPS functions ------------------------------
+    def convertInputStep(self):
+        with self.getProfiler().section('convert'):
+            # Trajectory and system are linked once (no copies), unless a reduced trajectory is needed
+            inpSystem = self.inputSystem.get()
+            sysFile = os.path.abspath(inpSystem.getSystemFile())
+            trajFile = os.path.abspath(inpSystem.getTrajectoryFile())
+            stageFiles([sysFile], self.getStagingDir())
+            if not self.isTrajectoryReduced():
+                stageFiles([trajFile], self.getStagingDir())
+                return
+
+            cache = Plugin.getResultsCache()
+            key = hashKey('reducedTrajectory', cache.fileHash(trajFile), cache.fileHash(sysFile),
+                          self.getFrameSelection(), self.getAtomSelection()) if self.useCache.get() else None
+            if key and cache.restore(key, self.getStagingDir()):
+                print('Reduced trajectory restored from cache ({})'.format(key))
+                return
+
+            outFiles = []
+            if self.isTrajectorySliced():
+                frameIndex = readXtcFrameIndex(trajFile)
+                frameIdxs = self.getFrameIdxs(len(frameIndex[0]))
+                if not frameIdxs:
+                    raise ValueError('No frames selected: the trajectory has {} frames and the selection is '
+                                     'first {}, last {}, stride {}'.format(len(frameIndex[0]),
+                                                                           *self.getFrameSelection()))
+                trajFile = writeXtcFrames(trajFile, self.getSlicedTrajectoryFile(), frameIdxs, frameIndex)
+                outFiles = [trajFile]
+            if self.stripSolvent.get():
+                nAtoms = writeAtomsSubset(sysFile, trajFile, self.getAtomSelection(),
+                                          self.getStagedSystemFile(), self.getStagedTrajectoryFile())
+                print('Trajectory reduced to {} atoms'.format(nAtoms))
+                if outFiles:
+                    os.remove(outFiles[0])
+                outFiles = [self.getStagedSystemFile(), self.getStagedTrajectoryFile()]
+
+            if key:
+                cache.store(key, outFiles)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validateTrajectory(self):
+        errors = []
+        trajExt = os.path.splitext(self.inputSystem.get().getTrajectoryFile())[1]
+        if self.isTrajectorySliced() and trajExt != '.xtc':
+            errors.append('Frames can only be selected for XTC trajectories')
+        if self.firstFrame.get() < 1 or self.frameStride.get() < 1:
+            errors.append('First frame and frame stride must be positive')
+        if self.lastFrame.get() != -1 and self.lastFrame.get() < self.firstFrame.get():
+            errors.append('Last frame must be -1 (until the end of the trajectory) or not lower than the first frame')
+        if self.stripSolvent.get() and not hasMDAnalysis():
+            errors.append('MDAnalysis is needed to strip the solvent. Install it in the Scipion environment '
+                          '(e.g: scipion3 run pip install MDAnalysis)')
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------------
+    def getProfiler(self):
+        return StepProfiler(self._getPath('profile.json'), enabled=self.profileSteps.get())
+
+    def getProfileSummary(self):
+        profileSummary = self.getProfiler().getSummary()
+        return [profileSummary] if profileSummary else []
+
+    def getFrameSelection(self):
+        return [self.firstFrame.get(), self.lastFrame.get(), self.frameStride.get()]
+
+    def isTrajectorySliced(self):
+        return self.getFrameSelection() != [1, -1, 1]
+
+    def getAtomSelection(self):
+        return self.atomSelection.get().strip() if self.stripSolvent.get() else None
+
+    def isTrajectoryReduced(self):
+        return self.isTrajectorySliced() or self.stripSolvent.get()
+
+    def getFrameIdxs(self, nFrames):
+        """ Returns the (0-based) indexes of the selected frames for a trajectory of nFrames """
+        first, last, stride = self.getFrameSelection()
+        last = nFrames if last < 1 else min(last, nFrames)
+        return list(range(first - 1, last, stride))
+
+    def getStagingDir(self):
+        return os.path.abspath(self._getExtraPath('inputSystem'))
+
+    def getSlicedTrajectoryFile(self):
+        return os.path.join(self.getStagingDir(), 'trajectory_slice.xtc')
+
+    def getStagedTrajectoryFile(self):
+        if self.stripSolvent.get():
+            return os.path.join(self.getStagingDir(), 'trajectory_stripped.xtc')
+        elif self.isTrajectorySliced():
+            return self.getSlicedTrajectoryFile()
+        return os.path.join(self.getStagingDir(), os.path.basename(self.inputSystem.get().getTrajectoryFile()))
+
+    def getStagedSystemFile(self):
+        if self.stripSolvent.get():
+            return os.path.join(self.getStagingDir(), 'system_stripped.pdb')
+        return os.path.join(self.getStagingDir(), os.path.basename(self.inputSystem.get().getSystemFile()))
@@ -33,23 +33,30 @@ This protocol is used to perform a pocket search on a protein structure using th
 
 import os, shutil
 import glob
+import numpy as np
 
-from pyworkflow.protocol import params
+from pyworkflow.protocol import params, STEPS_PARALLEL
 from pyworkflow.utils import Message
-from pyworkflow.object import String
-from pwem.protocols import EMProtocol
+from pyworkflow.object import String, Float
 
 from pwchem.objects import SetOfPockets, PredictPocketsOutput, ProteinPocket
 from pwchem.utils import clean_PDB
 
 from fpocket import Plugin
 from fpocket.constants import *
+from fpocket.protocols.protocol_mdpocket_base import MDpocketBase
+from fpocket.utils import linkFile, readPDBCoords, iterPDBModels, PDBModelsWriter, buildPointSetsIndex, \
+    assignToPointSets, computeSphereDescriptors, writeDescriptorsFile, groupOverlappingBoxes, writeAtomsSubset, \
+    hashKey, hasMDAnalysis, writeModifiedPocketFile, writeDescriptorsStore, getDescriptorNames, readDescriptorColumn, \
+    computeDescriptorStats, computeOpenFraction
 
-class MDpocketCharacterize(EMProtocol):
+class MDpocketCharacterize(MDpocketBase):
     """
     Executes the mdpocket software to look for protein pockets.
     """
     _label = 'Characterization of pockets'
+    _possibleOutputs = PredictPocketsOutput
+    stepsExecutionMode = STEPS_PARALLEL
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -65,72 +72,286 @@ class MDpocketCharacterize(EMProtocol):
                       label="Set of pockets obtained from trajectory ",
                       help='Characterization of pockets obtained in MD trajectory')
 
-    def _getMDpocketArgs(self, selPocket):
-        trajFile = self.inputSystem.get().getTrajectoryFile()
-        trajBasename = os.path.basename(trajFile)
-        args = ['--trajectory_file', trajBasename]
+        form.addParam('characMode', params.EnumParam, choices=CHARAC_MODES, default=0,
+                      label='Characterization mode: ', expertLevel=params.LEVEL_ADVANCED,
+                      help='*Per pocket*: one mdpocket run per pocket, computing the full set of mdpocket descriptors.\n'
+                           '*Single pass*: one mdpocket run over the merged selection of all the pockets, so the '
+                           'trajectory is read only once. The alpha spheres and atoms of each snapshot are then split '
+                           'by pocket and only the descriptors derived from the alpha spheres positions (number of '
+                           'alpha spheres, alpha sphere density and max distance to the mass center) are computed: '
+                           'no volume, surface, polarity nor hydrophobicity descriptors. Each sphere (atom) is '
+                           'assigned to the pocket with the closest point within {} A ({} A).'.
+                      format(SPHERE_ASSIGN_DIST, ATOM_ASSIGN_DIST))
+
+        form.addParam('cropRegion', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                      label='Crop the region of the pockets: ',
+                      help='Run mdpocket only over the receptor residues with atoms inside the bounding box of the '
+                           'pocket (plus a margin), writing a reduced topology and trajectory. Pockets whose regions '
+                           'overlap share the same cropped trajectory.\nRequires MDAnalysis.')
+        form.addParam('cropMargin', params.FloatParam, default=10.0, condition='cropRegion',
+                      expertLevel=params.LEVEL_ADVANCED, label='Crop margin (A): ',
+                      help='Distance added to each side of the bounding box of the pockets to select the receptor '
+                           'atoms. It should cover the motion of the pocket residues along the trajectory.')
+
+        self._defineTrajectoryParams(form)
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _getMDpocketArgs(self, selPocket, cropId=None):
+        trajFile = self.getStagedTrajectoryFile() if cropId is None else self.getCropTrajectoryFile(cropId)
+        args = ['--trajectory_file', trajFile]
 
         trajExt = os.path.splitext(trajFile)[1][1:]
         args += ['--trajectory_format', trajExt]
 
-        pdbFile = self.inputSystem.get().getSystemFile()
-        pdbBasename = os.path.basename(pdbFile)
-        args += ['-f', pdbBasename]
+        pdbFile = self.getStagedSystemFile() if cropId is None else self.getCropSystemFile(cropId)
+        args += ['-f', pdbFile]
 
-        # selPocket = os.path.abspath(self.selectedPocket.get()._getExtraPath("pocketFile_1.pdb")
         args += ['--selected_pocket', selPocket]
 
         return args
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        # Insert processing steps
-        self._insertFunctionStep('mdPocketStep')
+        # Insert processing steps: one independent mdpocket run per pocket, executed in parallel
+        cStep = self._insertFunctionStep('convertInputStep')
+        cropSteps, cropGroups = {}, self.getCropGroups() if self.cropRegion.get() else {}
+        if cropGroups:
+            for cropId, (pocketIds, boxMin, boxMax) in cropGroups.items():
+                cropSteps[cropId] = self._insertFunctionStep('cropRegionStep', cropId, boxMin, boxMax,
+                                                             prerequisites=[cStep])
+
+        if self.getEnumText('characMode') == 'Single pass':
+            mStep = self._insertFunctionStep('mergedPocketsStep', prerequisites=list(cropSteps.values()) or [cStep])
+            pSteps = [self._insertFunctionStep('splitPocketsStep', prerequisites=[mStep])]
+        else:
+            pocketCrops = {pocketId: cropId for cropId, (pocketIds, _, _) in cropGroups.items()
+                           for pocketId in pocketIds}
+            pSteps = []
+            for selPocket in self.selectedPocket.get():
+                cropId = pocketCrops.get(selPocket.getObjId())
+                pSteps.append(self._insertFunctionStep('mdPocketStep', selPocket.getObjId(),
+                                                       os.path.abspath(selPocket.getFileName()), cropId,
+                                                       prerequisites=[cropSteps[cropId] if cropSteps else cStep]))
+        self._insertFunctionStep('createOutputStep', prerequisites=pSteps)
+
+    def cropRegionStep(self, cropId, boxMin, boxMax):
+        with self.getProfiler().section('crop'):
+            # Receptor residues with atoms inside the box, from the (possibly stripped) staged system
+            cropDir = self.getCropDir(cropId)
+            os.makedirs(cropDir, exist_ok=True)
+            selection = self.getCropSelection(boxMin, boxMax)
+            key = None
+            if self.useCache.get():
+                cache = Plugin.getResultsCache()
+                key = hashKey('cropRegion', cache.fileHash(self.getStagedTrajectoryFile()),
+                              cache.fileHash(self.getStagedSystemFile()), selection)
+                if cache.restore(key, cropDir):
+                    print('Cropped trajectory restored from cache ({})'.format(key))
+                    return
+
+            nAtoms = writeAtomsSubset(self.getStagedSystemFile(), self.getStagedTrajectoryFile(), selection,
+                                      self.getCropSystemFile(cropId), self.getCropTrajectoryFile(cropId))
+            print('Region {} cropped to {} atoms'.format(cropId, nAtoms))
+            if key:
+                cache.store(key, [self.getCropSystemFile(cropId), self.getCropTrajectoryFile(cropId)])
+
+    def mdPocketStep(self, pocketId, pocketFile, cropId=None):
+        dir = os.path.abspath(self._getExtraPath('pocketFolder_{}'.format(pocketId)))
+        os.makedirs(dir, exist_ok=True)
+        with self.getProfiler().section('pocket file writing'):
+            modifiedPocketPdb = self.createPocketFileModified(pocketFile, pocketId, dir)
+        with self.getProfiler().section('mdpocket', kind='binary'):
+            Plugin.runMDpocket_2(self, 'mdpocket', args=self._getMDpocketArgs(modifiedPocketPdb, cropId), cwd=dir)
+        os.rename('{}/mdpout_mdpocket.pdb'.format(dir), '{}/mdpout_mdpocket_{}.pdb'.format(dir, pocketId))
+        os.rename('{}/mdpout_mdpocket_atoms.pdb'.format(dir), '{}/mdpout_mdpocket_atoms_{}.pdb'.format(dir, pocketId))
+        os.rename('{}/mdpout_descriptors.txt'.format(dir), '{}/mdpout_descriptors_{}.txt'.format(dir, pocketId))
+        # Typed columnar copy of the descriptors, so the viewer loads only the column it displays
+        writeDescriptorsStore('{}/mdpout_descriptors_{}.txt'.format(dir, pocketId))
+
+    def mergedPocketsStep(self):
+        # A single mdpocket run over the selection of all the pockets together
+        dir = self.getMergedDir()
+        os.makedirs(dir, exist_ok=True)
+        mergedPdb = os.path.join(dir, 'pocketFile_Modified_merged.pdb')
+        with self.getProfiler().section('pocket file writing'), open(mergedPdb, 'w') as f:
+            for selPocket in self.selectedPocket.get():
+                modifiedPocketPdb = self.createPocketFileModified(os.path.abspath(selPocket.getFileName()),
+                                                                  selPocket.getObjId(), dir)
+                with open(modifiedPocketPdb) as fMod:
+                    f.writelines(line if line.endswith('\n') else line + '\n'
+                                 for line in fMod if line.startswith(('ATOM', 'HETATM')))
+            f.write('END\n')
+
+        cropId = 1 if self.cropRegion.get() else None
+        with self.getProfiler().section('mdpocket', kind='binary'):
+            Plugin.runMDpocket_2(self, 'mdpocket', args=self._getMDpocketArgs(mergedPdb, cropId), cwd=dir)
+
+    def splitPocketsStep(self):
+        with self.getProfiler().section('descriptors split'):
+            # The alpha spheres and atoms of each snapshot are assigned to the closest pocket
+            dir = self.getMergedDir()
+            pocketIds, pocketCoords = [], []
+            for selPocket in self.selectedPocket.get():
+                pocketIds.append(selPocket.getObjId())
+                pocketCoords.append(readPDBCoords(os.path.abspath(selPocket.getFileName())))
+
+            pDirs = []
+            for pocketId in pocketIds:
+                pDir = os.path.abspath(self._getExtraPath('pocketFolder_{}'.format(pocketId)))
+                os.makedirs(pDir, exist_ok=True)
+                linkFile(os.path.join(dir, 'pocketFile_Modified_{}.pdb'.format(pocketId)),
+                         os.path.join(pDir, 'pocketFile_Modified_{}.pdb'.format(pocketId)))
+                pDirs.append(pDir)
+
+            #The mdpocket outputs are read and split in blocks of snapshots, so they are never fully in memory
+            sphereIndex = buildPointSetsIndex(pocketCoords, maxDist=SPHERE_ASSIGN_DIST)
+            sphereWriters = [PDBModelsWriter(os.path.join(pDir, 'mdpout_mdpocket_{}.pdb'.format(pocketId)))
+                             for pDir, pocketId in zip(pDirs, pocketIds)]
+            descBlocks = [[] for _ in pocketIds]
+            nModels = 0
+            for firstModel, nBlockModels, lines, coords, models in \
+                    iterPDBModels(os.path.join(dir, 'mdpout_mdpocket.pdb')):
+                labels = assignToPointSets(coords, sphereIndex)
+                for i, writer in enumerate(sphereWriters):
+                    idxs = np.where(labels == i)[0]
+                    writer.write(lines[idxs], firstModel + models[idxs])
+                    descBlocks[i].append(computeSphereDescriptors(coords[idxs], models[idxs], nBlockModels))
+                nModels = firstModel + nBlockModels
+            for writer in sphereWriters:
+                writer.close(nModels)
 
+            atomIndex = buildPointSetsIndex(pocketCoords, maxDist=ATOM_ASSIGN_DIST)
+            atomWriters = [PDBModelsWriter(os.path.join(pDir, 'mdpout_mdpocket_atoms_{}.pdb'.format(pocketId)))
+                           for pDir, pocketId in zip(pDirs, pocketIds)]
+            for firstModel, _, lines, coords, models in iterPDBModels(os.path.join(dir, 'mdpout_mdpocket_atoms.pdb')):
+                labels = assignToPointSets(coords, atomIndex)
+                for i, writer in enumerate(atomWriters):
+                    idxs = np.where(labels == i)[0]
+                    writer.write(lines[idxs], firstModel + models[idxs])
+            for writer in atomWriters:
+                writer.close(nModels)
 
-    def mdPocketStep(self):
+            for pDir, pocketId, blocks in zip(pDirs, pocketIds, descBlocks):
+                #No blocks if mdpocket did not write any snapshot: empty descriptors file
+                blocks = blocks or [computeSphereDescriptors(np.zeros((0, 3)), np.zeros(0, dtype=int), 0)]
+                descDic = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+                descDic['snapshot'] = np.arange(1, nModels + 1)
+                descFile = writeDescriptorsFile(os.path.join(pDir, 'mdpout_descriptors_{}.txt'.format(pocketId)),
+                                                descDic)
+                writeDescriptorsStore(descFile)
 
-        for selPocket in (self.selectedPocket.get()):
-            trajFile = os.path.abspath(self.inputSystem.get().getTrajectoryFile())
-            pdbFile = os.path.abspath(self.inputSystem.get().getSystemFile())
-            pocketFile = selPocket.getFileName()
-            dir = os.path.abspath(self._getExtraPath('pocketFolder_{}'.format(selPocket.getObjId())))
-            os.mkdir(dir)
-            modifiedPocketPdb = self.createPocketFileModified(os.path.abspath(pocketFile), selPocket, dir)
-            os.system('cd {} && cp {} {} {} ./'.format(dir, trajFile, pdbFile, os.path.abspath(pocketFile), modifiedPocketPdb))
-            Plugin.runMDpocket_2(self, 'mdpocket', args=self._getMDpocketArgs(os.path.basename(modifiedPocketPdb)), cwd=dir)
-            os.system('cd {} && rm {} {} {} ./'.format(dir, os.path.basename(trajFile), os.path.basename(pdbFile), os.path.basename(pocketFile)))
-            os.rename('{}/mdpout_mdpocket.pdb'.format(dir), '{}/mdpout_mdpocket_{}.pdb'.format(dir, selPocket.getObjId()))
-            os.rename('{}/mdpout_mdpocket_atoms.pdb'.format(dir), '{}/mdpout_mdpocket_atoms_{}.pdb'.format(dir, selPocket.getObjId()))
-            os.rename('{}/mdpout_descriptors.txt'.format(dir), '{}/mdpout_descriptors_{}.txt'.format(dir, selPocket.getObjId()))
+    def createOutputStep(self):
+        # The descriptors statistics of each pocket are stored as its attributes, so pockets can be ranked by them
+        with self.getProfiler().section('sqlite output'):
+            outPockets = SetOfPockets(filename=self._getPath('pockets.sqlite'))
+            for selPocket in self.selectedPocket.get():
+                pocket = selPocket.clone()
+                self.setDescriptorStats(pocket, self.getDescriptorsFile(selPocket.getObjId()))
+                outPockets.append(pocket)
+            outPockets.buildPDBhetatmFile()
 
+        self._defineOutputs(**{self._possibleOutputs.outputPockets.name: outPockets})
+        self._defineSourceRelation(self.selectedPocket, outPockets)
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
+        if hasattr(self, 'outputPockets'):
+            summary.append('Descriptors statistics ({}) stored in the {} output pockets as _<descriptor>_<statistic> '
+                           'attributes, with their open fraction'.format(', '.join(DESCRIPTOR_STATS),
+                                                                        len(self.outputPockets)))
+        summary += self.getProfileSummary()
         return summary
 
     def _methods(self):
         methods = []
         return methods
 
+    def _validate(self):
+        errors = self._validateTrajectory()
+        if self.cropRegion.get() and not hasMDAnalysis():
+            errors.append('MDAnalysis is needed to crop the pockets region. Install it in the Scipion environment '
+                          '(e.g: scipion3 run pip install MDAnalysis)')
+        return errors
+
     def _warnings(self):
         """ Try to find warnings on define params. """
         warnings = []
+        if self.getEnumText('characMode') == 'Single pass':
+            warnings.append('In single pass mode only these descriptors are computed: {}. The rest of mdpocket '
+                            'descriptors (volume, surfaces, polarity, hydrophobicity...) need the per pocket '
+                            'mode'.format(', '.join(SINGLE_PASS_DESCRIPTORS)))
         return warnings
 
     # --------------------------- UTILS functions -----------------------------------
+    def getDescriptorsFile(self, pocketId):
+        return os.path.abspath(self._getExtraPath('pocketFolder_{}'.format(pocketId),
+                                                  'mdpout_descriptors_{}.txt'.format(pocketId)))
+
+    def setDescriptorStats(self, pocket, descFile):
+        """ Sets the statistics of the pocket descriptors as _<descriptor>_<statistic> attributes, plus the fraction
+        of snapshots where the pocket is open (_openFraction). Only the mdpocket descriptors are summarized, not the
+        snapshot or other bookkeeping columns of the file """
+        descNames = getDescriptorNames(descFile)
+        descDic = {name: readDescriptorColumn(descFile, name) for name in MDPOCKET_DESCRIPTORS if name in descNames}
+        for descName, descStats in computeDescriptorStats(descDic).items():
+            for statName in DESCRIPTOR_STATS:
+                if statName in descStats:
+                    setattr(pocket, '_{}_{}'.format(descName, statName), Float(descStats[statName]))
+        openFraction = computeOpenFraction(descDic)
+        if openFraction is not None:
+            pocket._openFraction = Float(openFraction)
+
+    def getMergedDir(self):
+        return os.path.abspath(self._getExtraPath('mergedPockets'))
+
+    def getCropGroups(self):
+        """ Groups the pockets whose cropping boxes overlap. In single pass mode, all the pockets are cropped together.
+        Returns a dictionary {cropId: (pocketIds, boxMin, boxMax)} """
+        pocketIds, boxMins, boxMaxs = [], [], []
+        for selPocket in self.selectedPocket.get():
+            coords = readPDBCoords(os.path.abspath(selPocket.getFileName()))
+            pocketIds.append(selPocket.getObjId())
+            boxMins.append(coords.min(axis=0) - self.cropMargin.get())
+            boxMaxs.append(coords.max(axis=0) + self.cropMargin.get())
+        boxMins, boxMaxs = np.array(boxMins), np.array(boxMaxs)
+
+        if self.getEnumText('characMode') == 'Single pass':
+            labels = np.zeros(len(pocketIds), dtype=int)
+        else:
+            labels = groupOverlappingBoxes(boxMins, boxMaxs)
+
+        groups = {}
+        for cropId, label in enumerate(np.unique(labels)):
+            idxs = np.where(labels == label)[0]
+            groups[cropId + 1] = ([pocketIds[i] for i in idxs], boxMins[idxs].min(axis=0).round(3).tolist(),
+                                  boxMaxs[idxs].max(axis=0).round(3).tolist())
+        return groups
+
+    def getPocketSystemFiles(self, pocketId):
+        """ Returns the (system, trajectory) files mdpocket was run on for a pocket: its cropped region or the
+        staged input system """
+        if self.cropRegion.get():
+            for cropId, (pocketIds, _, _) in self.getCropGroups().items():
+                if pocketId in pocketIds:
+                    return self.getCropSystemFile(cropId), self.getCropTrajectoryFile(cropId)
+        return self.getStagedSystemFile(), self.getStagedTrajectoryFile()
+
+    def getCropSelection(self, boxMin, boxMax):
+        receptorSel = self.getAtomSelection() or 'protein'
+        boxSel = ' and '.join('prop {} >= {} and prop {} <= {}'.format(axis, bMin, axis, bMax)
+                              for axis, bMin, bMax in zip('xyz', boxMin, boxMax))
+        return 'byres (({}) and {})'.format(receptorSel, boxSel)
+
+    def getCropDir(self, cropId):
+        return os.path.abspath(self._getExtraPath('cropRegion_{}'.format(cropId)))
+
+    def getCropSystemFile(self, cropId):
+        return os.path.join(self.getCropDir(cropId), 'crop_system.pdb')
+
+    def getCropTrajectoryFile(self, cropId):
+        return os.path.join(self.getCropDir(cropId), 'crop_trajectory.xtc')
 
-    def createPocketFileModified(self, pocketFile, selPocket, dir):
-        outFile = os.path.join(dir, 'pocketFile_Modified_{}.pdb'.format(selPocket.getObjId()))
-        modFile = open(outFile, 'w')
-        with open(pocketFile, 'r') as f:
-
-            checkWords = ("HETATM", "APOL", "C", "STP", "Ve")
-            repWords = ("ATOM  ", "", "PTH  ", "C  ", "C  ")
-            for line in f:
-                for check, rep in zip(checkWords, repWords):
-                    line = line.replace(check, rep)
-                modFile.write(line)
-            modFile.close()
-        return outFile
\ No newline at end of file
+    def createPocketFileModified(self, pocketFile, pocketId, dir):
+        outFile = os.path.join(dir, 'pocketFile_Modified_{}.pdb'.format(pocketId))
+        return writeModifiedPocketFile(pocketFile, outFile)
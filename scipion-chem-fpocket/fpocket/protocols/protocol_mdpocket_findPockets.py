@@ -31,20 +31,25 @@ This protocol is used to perform a pocket search on a protein structure using th
 
 """
 
-import os, shutil
+import os, shutil, glob, json
+import numpy as np
 
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
-from pyworkflow.object import String
-from pwem.protocols import EMProtocol
+from pyworkflow.object import String, Float
 #from pwem.protocols import protocol_define_manual_pockets
 
 from pwchem.objects import SetOfPockets, PredictPocketsOutput, ProteinPocket
 from pwchem.utils import *
 from fpocket import Plugin
 from fpocket.constants import *
+from fpocket.protocols.protocol_mdpocket_base import MDpocketBase
+from fpocket.utils import readDXGrid, SparseGrid, getSparseGridFile, convertDXToSparse, parseValuesList, \
+    singleLinkageClusters, readPDBCoords, writePDBCoords, CellList, pointSetsContacts, hashKey, splitXtcWindows, \
+    writeDXGrid, mergeGrids, readXtcFrameIndex, writeGridPyramid
+from fpocket.jobs import ProgressMonitor, formatSeconds
 
-class MDpocketAnalyze(EMProtocol):
+class MDpocketAnalyze(MDpocketBase):
     """
     Executes the mdpocket software to look for protein pockets.
     """
@@ -64,6 +69,12 @@ class MDpocketAnalyze(EMProtocol):
         group.addParam('isoValue', params.FloatParam, default=1.0,
                        label='Selected Isovalue',
                        help='Selected Isovalue Threshold in Pocket Analysis for PDB output')
+        group.addParam('sweepIsoValues', params.StringParam, default='',
+                       label='Additional isovalues to sweep: ', expertLevel=params.LEVEL_ADVANCED,
+                       help='Additional isovalue thresholds, as comma separated values and/or ranges in the '
+                            'form start:stop:step (e.g: "0.5, 2:4:0.5"). The density grid is loaded once and an '
+                            'extra output set of pockets (outputPockets_1, outputPockets_2...) is generated '
+                            'for each of them, without running mdpocket again.')
         group.addParam('maxIntraDistance', params.FloatParam, default='2.0',
                        label='Maximum distance between pocket points (A): ',
                        help='Maximum distance between two pocket atoms to considered them same pocket')
@@ -74,14 +85,30 @@ class MDpocketAnalyze(EMProtocol):
                    help='Detect different type of pockets with a set of specific inner parameters'
                    )
 
-    def _getMDpocketArgs(self):
-        trajFile = os.path.abspath(self.inputSystem.get().getTrajectoryFile())
+        self._defineTrajectoryParams(form)
+        form.addParam('nWindows', params.IntParam, default=1, expertLevel=params.LEVEL_ADVANCED,
+                      label='Number of trajectory windows: ',
+                      help='Split the trajectory (XTC only) into this number of contiguous frame windows and run '
+                           'mdpocket on them concurrently (as many at once as threads). The density and frequency '
+                           'grids of the windows are then merged weighting them by their number of frames.')
+        form.addParam('keepDXGrids', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label='Keep ASCII DX grids: ',
+                      help='The density and frequency grids are always stored in a compressed sparse format '
+                           '(mdpout_*_grid.sparse.npz), which is the one read by the protocol. If No, the ASCII DX '
+                           'files are removed to save disk space and the output pockets do not have the densVolFile '
+                           'and freqVolFile attributes, only densSparseFile and freqSparseFile (the plugin viewers '
+                           'export the DX files again when needed).')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _getMDpocketArgs(self, trajFile=None):
+        trajFile = self.getStagedTrajectoryFile() if trajFile is None else os.path.abspath(trajFile)
         args = ['--trajectory_file', trajFile]
 
         trajExt = os.path.splitext(trajFile)[1][1:]
         args += ['--trajectory_format', trajExt]
 
-        pdbFile = os.path.abspath(self.inputSystem.get().getSystemFile())
+        pdbFile = self.getStagedSystemFile()
         args += ['-f', pdbFile]
 
         selPock = self.getEnumText('pockType')
@@ -95,31 +122,18 @@ class MDpocketAnalyze(EMProtocol):
             args += ['-S']
 
         elif selPock == 'Channels and small cavities':
-            args += [' -m 2.8 -M 5.5 -i 3']
+            args += ['-m', 2.8, '-M', 5.5, '-i', 3]
 
         elif selPock == 'Water binding sites':
-            args += ['-m 3.5 -M 5.5 -i 3']
+            args += ['-m', 3.5, '-M', 5.5, '-i', 3]
 
         elif selPock == 'Big external pockets':
-            args += ['-m 3.5 -M 10.0 -i 3']
+            args += ['-m', 3.5, '-M', 10.0, '-i', 3]
 
         args +=['-C']
 
         return args
 
-    def _getselIsovalueArgs(self):
-    # python extractISOPdb.py path / my_dx_file.dx outputname.pdb isovalue
-
-        volFile = os.path.abspath(self._getExtraPath("mdpout_dens_grid.dx")) #To get the extra path between home path and protocol
-        args = [volFile]
-
-        outputName = 'mdpoutput-{}.pdb'.format(str(self.isoValue.get()))
-        args += [outputName]
-
-        isoValue = self.isoValue.get()
-        args += [isoValue]
-        return args
-
     def _clusterizedPocketsArgs(self):
         inpPdb = os.path.abspath(self._getExtraPath("mdpout_dens_iso_8.dx"))
         inpPdb += [inpPdb]
@@ -129,33 +143,147 @@ class MDpocketAnalyze(EMProtocol):
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         # Insert processing steps
-        self._insertFunctionStep('mdPocketStep')
+        self._insertFunctionStep('convertInputStep')
+        if self.nWindows.get() > 1:
+            self._insertFunctionStep('splitTrajectoryStep')
+            self._insertFunctionStep('mdPocketWindowsStep')
+            self._insertFunctionStep('mergeGridsStep')
+        else:
+            self._insertFunctionStep('mdPocketStep')
         self._insertFunctionStep('createOutputStep')
+        self._insertFunctionStep('compressGridsStep')
         self._insertFunctionStep('selIsovalue')
         self._insertFunctionStep('defineOutputStep')
 
     def mdPocketStep(self):
-        Plugin.runMDpocket(self, 'mdpocket', args=self._getMDpocketArgs(), cwd=self._getExtraPath())
+        with self.getProfiler().section('mdpocket', kind='binary'):
+            monitor = ProgressMonitor(self.getTrajectoryFrames(), self.getTimelineFile())
+            if not self.useCache.get():
+                Plugin.runMDpocket(self, 'mdpocket', args=self._getMDpocketArgs(), cwd=self._getExtraPath(),
+                                   monitor=monitor)
+                return
+
+            # The mdpocket grids are an intermediate product cached by trajectory, topology and arguments
+            cache = Plugin.getResultsCache()
+            key = self.getCacheKey(cache)
+            if cache.restore(key, self._getExtraPath()):
+                print('MDpocket grids restored from cache ({})'.format(key))
+            else:
+                Plugin.runMDpocket(self, 'mdpocket', args=self._getMDpocketArgs(), cwd=self._getExtraPath(),
+                                   monitor=monitor)
+                cache.store(key, glob.glob(self._getExtraPath('mdpout_*')))
+
+    def splitTrajectoryStep(self):
+        with self.getProfiler().section('trajectory split'):
+            cache = Plugin.getResultsCache()
+            if self.useCache.get() and cache.restore(self.getCacheKey(cache), self._getExtraPath()):
+                print('MDpocket grids restored from cache')
+                return
+
+            windows = splitXtcWindows(self.getStagedTrajectoryFile(), os.path.abspath(self._getExtraPath()),
+                                      self.nWindows.get())
+            with open(self.getWindowsFile(), 'w') as f:
+                json.dump(windows, f)
+
+    def mdPocketWindowsStep(self):
+        with self.getProfiler().section('mdpocket', kind='binary'):
+            # All the windows are submitted at once, running as many at the same time as threads
+            jobsArgs, monitors = [], []
+            for i in range(1, self.nWindows.get() + 1):
+                winTrajFile = self.getWindowTrajectory(i)
+                if winTrajFile is not None:
+                    #Otherwise, grids restored from cache or window without frames
+                    winDir = os.path.abspath(self._getExtraPath('window_{}'.format(i)))
+                    os.makedirs(winDir, exist_ok=True)
+                    jobsArgs.append((self._getMDpocketArgs(winTrajFile), winDir))
+                    monitors.append(ProgressMonitor(self.getWindowFrames(i), self.getTimelineFile(i)))
+            Plugin.runMDpocketJobs(self, 'mdpocket', jobsArgs, maxJobs=max(self.numberOfThreads.get(), 1),
+                                   monitors=monitors)
+
+    def mergeGridsStep(self):
+        with self.getProfiler().section('grid merge'):
+            if not os.path.exists(self.getWindowsFile()):
+                return
+            with open(self.getWindowsFile()) as f:
+                windows = json.load(f)
+
+            nFrames = [winFrames for _, winFrames in windows]
+            for gridName in ['mdpout_dens_grid.dx', 'mdpout_freq_grid.dx']:
+                grids = [readDXGrid(os.path.join(self._getExtraPath('window_{}'.format(i + 1)), gridName),
+                                    useCache=False)
+                         for i in range(len(windows))]
+                writeDXGrid(self._getExtraPath(gridName), *mergeGrids(grids, nFrames))
+
+            for winFile, _ in windows:
+                os.remove(winFile)
+            if self.useCache.get():
+                cache = Plugin.getResultsCache()
+                cache.store(self.getCacheKey(cache), glob.glob(self._getExtraPath('mdpout_*_grid.dx')))
+
+    def compressGridsStep(self):
+        # Sparse grids, plus their coarser versions for a fast first look in the viewer
+        with self.getProfiler().section('grid compression'):
+            for gridFile in [self.getDensGridFile(), self.getFreqGridFile()]:
+                if os.path.exists(gridFile):
+                    convertDXToSparse(gridFile, removeDX=not self.keepDXGrids.get())
+                    writeGridPyramid(gridFile, GRID_PYRAMID_FACTORS)
 
     def selIsovalue(self):
-        Plugin.runSelIsovalue(self, 'extractISOPdb.py', args=self._getselIsovalueArgs(), cwd=self._getExtraPath())
+        with self.getProfiler().section('isovalue extraction'):
+            # Grid points over each isovalue are extracted in process from the non zero voxels of the density grid
+            grid = SparseGrid(getSparseGridFile(self.getDensGridFile()))
+            for isoValue in self.getIsoValues():
+                np.save(self.getIsoCoordsFile(isoValue), grid.getIsoCoords(isoValue))
 
     def defineOutputStep(self):
-        coords = self.getCoords()
-        self.coordsClusters = clusterCoords(coords, self.maxIntraDistance.get())
-
-        outPockets = SetOfPockets(filename=self._getPath('pockets.sqlite'))
-        for i, clust in enumerate(self.coordsClusters):
-            pocketFile = self.createPocketFile(clust, i)
-            pocket = ProteinPocket(pocketFile, self.inputSystem.get().getSystemFile())
-            pocket.calculateContacts()
-            outPockets.append(pocket)
-
-        if len(outPockets) >= 0: #Sometimes with the isovalue of 1 no pockets are detected, so still we want the output to be visualized
+        outputs = {}
+        for k, isoValue in enumerate(self.getIsoValues()):
+            if k == 0:
+                outName, outDir, setFile = 'outputPockets', self._getExtraPath(), self._getPath('pockets.sqlite')
+            else:
+                outName, outDir = 'outputPockets_{}'.format(k), self._getExtraPath('isoValue_{}'.format(isoValue))
+                setFile = self._getPath('pockets_{}.sqlite'.format(k))
+                os.makedirs(outDir, exist_ok=True)
+            outputs[outName] = self.buildPocketsSet(isoValue, outDir, setFile)
+
+        self._defineOutputs(**outputs)
+
+    def buildPocketsSet(self, isoValue, outDir, setFile):
+        profiler = self.getProfiler()
+        with profiler.section('clustering'):
+            coords = self.getCoords(isoValue)
+            coordsClusters = singleLinkageClusters(coords, self.maxIntraDistance.get())
+
+        with profiler.section('pocket file writing'):
+            pockets = []
+            for i, clust in enumerate(coordsClusters):
+                pocketFile = self.createPocketFile(clust, i, outDir)
+                pockets.append(ProteinPocket(pocketFile, self.inputSystem.get().getSystemFile()))
+
+        # Contacts of all the pockets in one query against the receptor atoms index
+        with profiler.section('contact calculation'):
+            if pockets:
+                proteinAtoms, atomsIndex = self.getProteinAtomsIndex(pockets[0])
+                contactIdxs = pointSetsContacts(coordsClusters, atomsIndex, CONTACT_DIST)
+                for pocket, atomIdxs in zip(pockets, contactIdxs):
+                    self.setPocketContacts(pocket, [proteinAtoms[j] for j in atomIdxs])
+
+        with profiler.section('sqlite output'):
+            outPockets = SetOfPockets(filename=setFile)
+            for pocket in pockets:
+                outPockets.append(pocket)
+
+            #Sometimes with the isovalue of 1 no pockets are detected, so still we want the output to be visualized
             outPockets.buildPDBhetatmFile()
-            outPockets.densVolFile = String(os.path.abspath(self._getExtraPath('mdpout_dens_grid.dx')))
-            outPockets.freqVolFile = String(os.path.abspath(self._getExtraPath('mdpout_freq_grid.dx')))
-            self._defineOutputs(outputPockets=outPockets)
+        #DX grids are only set if they were kept. Their sparse versions can be exported with ensureDXGrid
+        outPockets.densSparseFile = String(getSparseGridFile(self.getDensGridFile()))
+        outPockets.freqSparseFile = String(getSparseGridFile(self.getFreqGridFile()))
+        if os.path.exists(self.getDensGridFile()):
+            outPockets.densVolFile = String(self.getDensGridFile())
+        if os.path.exists(self.getFreqGridFile()):
+            outPockets.freqVolFile = String(self.getFreqGridFile())
+        outPockets.isoValue = Float(isoValue)
+        return outPockets
 
     def createOutputStep(self):
         pass
@@ -164,12 +292,34 @@ class MDpocketAnalyze(EMProtocol):
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
+        for timelineFile in sorted(glob.glob(self.getTimelineFile('*'))) or glob.glob(self.getTimelineFile()):
+            with open(timelineFile) as f:
+                stats = json.load(f)['summary']
+            runName = os.path.splitext(os.path.basename(timelineFile))[0].replace('mdpocket_timeline', 'mdpocket')
+            summary.append('{}: {} frames in {} ({:.2f} frames/s), peak RSS {:.1f} MB'.
+                           format(runName.replace('_', ' '), stats['framesDone'], formatSeconds(stats['elapsed']),
+                                  stats['framesPerSecond'], stats['peakRssMB']))
+        summary += self.getProfileSummary()
         return summary
 
     def _methods(self):
         methods = []
         return methods
 
+    def _validate(self):
+        errors = self._validateTrajectory()
+        trajExt = os.path.splitext(self.inputSystem.get().getTrajectoryFile())[1]
+        if self.nWindows.get() > 1 and trajExt != '.xtc':
+            errors.append('The trajectory can only be split in windows for XTC files')
+        if self.maxIntraDistance.get() is None or self.maxIntraDistance.get() <= 0:
+            errors.append('The maximum distance between pocket points must be positive')
+        try:
+            parseValuesList(self.sweepIsoValues.get())
+        except ValueError as e:
+            errors.append('Could not parse the additional isovalues "{}" ({}). Use comma separated values and/or '
+                          'ranges in the form start:stop:step'.format(self.sweepIsoValues.get(), e))
+        return errors
+
     def _warnings(self):
         """ Try to find warnings on define params. """
         warnings = []
@@ -177,44 +327,80 @@ class MDpocketAnalyze(EMProtocol):
 
     # --------------------------- UTILS functions -----------------------------------
 
-    def getCoords(self):
-        pdbFile = os.path.abspath(self._getExtraPath('mdpoutput-{}.pdb'.format(str(self.isoValue.get()))))
-        coords = []
-        for pdbLine in open(pdbFile):
-            line = pdbLine.split()
-            coord = line[5:8]
-            coord = list(map(float,coord))
-            coords.append(coord)
-        return coords
-
-    def createPocketFile(self, clust, i):
-        outFile = self._getExtraPath('pocketFile_{}.pdb'.format(i+1))
-        with open(outFile, 'w') as f:
-            for j, coord in enumerate(clust):
-                f.write(writePDBLine(['HETATM', str(j + 1), 'APOL', 'STP', 'C', '1', *coord, 1.0, 0.0, '', 'Ve']))
-                #f.write(writePDBLine(['ATOM', str(j+1), '', 'C', 'PTH', '1', *coord, 0.0, 0.0, '', 'C']))
-
-            f.write('\nEND')
-        return outFile
-
-    # def clusterCoords(coords, maxDist):
-    #     clusters = []
-    #     for coord in coords:
-    #         newClusters = []
-    #         newClust = [coord]
-    #         for clust in clusters:
-    #             merge = False
-    #             for cCoord in clust:
-    #                 dist = calculateDistance(coord, cCoord)
-    #                 if dist < maxDist:
-    #                     merge = True
-    #                     break
-    #
-    #             if merge:
-    #                 newClust += clust
-    #             else:
-    #                 newClusters.append(clust)
-    #
-    #         newClusters.append(newClust)
-    #         clusters = newClusters.copy()
-    #     return clusters
\ No newline at end of file
+    def getDensGridFile(self):
+        return os.path.abspath(self._getExtraPath('mdpout_dens_grid.dx'))
+
+    def getFreqGridFile(self):
+        return os.path.abspath(self._getExtraPath('mdpout_freq_grid.dx'))
+
+    def getCacheKey(self, cache):
+        """ Key of the mdpocket results: hashes of the trajectory and topology and the rest of arguments """
+        inpFiles = [self.getStagedTrajectoryFile(), self.getStagedSystemFile()]
+        args = [os.path.basename(arg) if arg in inpFiles else arg for arg in self._getMDpocketArgs()]
+        if self.nWindows.get() > 1:
+            args += ['windows', self.nWindows.get()]
+        return hashKey('mdpocket', *[cache.fileHash(inpFile) for inpFile in inpFiles], args)
+
+    def getWindowsFile(self):
+        return os.path.abspath(self._getExtraPath('windows.json'))
+
+    def getTimelineFile(self, window=None):
+        if window is None:
+            return self._getExtraPath('mdpocket_timeline.json')
+        return self._getExtraPath('mdpocket_timeline_window_{}.json'.format(window))
+
+    def getTrajectoryFrames(self):
+        """ Number of frames of the (staged) trajectory, read from the frame headers. None if it is not XTC """
+        trajFile = self.getStagedTrajectoryFile()
+        if os.path.splitext(trajFile)[1] == '.xtc':
+            return len(readXtcFrameIndex(trajFile)[0])
+
+    def getWindowFrames(self, i):
+        with open(self.getWindowsFile()) as f:
+            return json.load(f)[i - 1][1]
+
+    def getWindowTrajectory(self, i):
+        """ Returns the trajectory file of the i-th window (1-based), None if it was not created """
+        if not os.path.exists(self.getWindowsFile()):
+            return None
+        with open(self.getWindowsFile()) as f:
+            windows = json.load(f)
+        return windows[i - 1][0] if i <= len(windows) else None
+
+    def getIsoValues(self):
+        """ Returns the main isovalue followed by the additional sweep isovalues """
+        isoValues = [self.isoValue.get()]
+        for isoValue in parseValuesList(self.sweepIsoValues.get()):
+            if isoValue not in isoValues:
+                isoValues.append(isoValue)
+        return isoValues
+
+    def getIsoCoordsFile(self, isoValue=None):
+        isoValue = self.isoValue.get() if isoValue is None else isoValue
+        return os.path.abspath(self._getExtraPath('mdpoutput-{}.npy'.format(str(isoValue))))
+
+    def getCoords(self, isoValue=None):
+        isoCoordsFile = self.getIsoCoordsFile(isoValue)
+        if not os.path.exists(isoCoordsFile):
+            #Isovalue points extracted as PDB by previous versions of the protocol
+            return readPDBCoords(isoCoordsFile.replace('.npy', '.pdb'))
+        return np.load(isoCoordsFile)
+
+    def getProteinAtomsIndex(self, pocket):
+        """ Returns the receptor atoms and a spatial index of their coordinates, built once per run """
+        if getattr(self, '_atomsIndex', None) is None:
+            proteinAtoms = pocket.getProteinAtoms()
+            atomCoords = np.array([atom.getCoords() for atom in proteinAtoms], dtype=float).reshape(-1, 3)
+            self._atomsIndex = proteinAtoms, CellList(atomCoords, CONTACT_DIST)
+        return self._atomsIndex
+
+    def setPocketContacts(self, pocket, contactAtoms):
+        """ Stores the contact atoms and residues in the pocket, as ProteinPocket.calculateContacts does """
+        pocket.setContactAtoms(pocket.encodeIds(pocket.getAtomsIds(contactAtoms)))
+        contactResidues = pocket.getContactResidues(contactAtoms)
+        pocket.setContactResidues(pocket.encodeIds(pocket.getResiduesIds(contactResidues)))
+
+    def createPocketFile(self, clust, i, outDir=None):
+        outDir = self._getExtraPath() if outDir is None else outDir
+        outFile = os.path.join(outDir, 'pocketFile_{}.pdb'.format(i+1))
+        return writePDBCoords(outFile, clust)
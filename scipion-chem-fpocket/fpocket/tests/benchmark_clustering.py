@@ -0,0 +1,128 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of the clustering of the isovalue grid points used by MDpocketAnalyze:
+pairwise merge clustering vs cell list single linkage on synthetic density grids. The points are extracted from the
+stored sparse grid, and the protocol path time covers that extraction plus the cell list clustering.
+
+    python -m fpocket.tests.benchmark_clustering
+"""
+
+import os, time, tempfile
+import numpy as np
+
+from fpocket.utils import singleLinkageClusters, writeSparseGrid, SparseGrid
+
+MAX_DIST = 2.0
+BLOB_SIZES = [(16, 4), (24, 8), (40, 20), (64, 60), (96, 150)]  # (grid edge, number of density blobs)
+MAX_PAIRWISE_POINTS = 3000
+
+
+def pairwiseClusters(coords, maxDist):
+    """ Reference pairwise merge clustering (previous MDpocketAnalyze implementation) """
+    clusters = []
+    for coord in coords:
+        newClusters = []
+        newClust = [coord]
+        for clust in clusters:
+            merge = False
+            for cCoord in clust:
+                dist = np.linalg.norm(np.array(coord) - np.array(cCoord))
+                if dist < maxDist:
+                    merge = True
+                    break
+
+            if merge:
+                newClust += clust
+            else:
+                newClusters.append(clust)
+
+        newClusters.append(newClust)
+        clusters = newClusters.copy()
+    return clusters
+
+
+def syntheticDensityGrid(edge, nBlobs, seed=0):
+    """ Density grid (1 A spacing) made of gaussian blobs of random widths, as a mdpocket density grid """
+    rng = np.random.default_rng(seed)
+    axis = np.arange(edge)
+    x, y, z = np.meshgrid(axis, axis, axis, indexing='ij')
+    grid = np.zeros((edge, edge, edge))
+    for center, width in zip(rng.uniform(0, edge, (nBlobs, 3)), rng.uniform(1.0, 3.0, nBlobs)):
+        grid += 3 * np.exp(-((x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2) / (2 * width ** 2))
+    return grid, np.zeros(3), np.ones(3)
+
+
+def asClusterSets(clusters):
+    return sorted(sorted(tuple(np.round(coord, 3)) for coord in clust) for clust in clusters)
+
+
+def timeIt(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def protocolClusters(sparseFile, isoValue, maxDist):
+    """ Isovalue points of the stored sparse grid clustered into pockets, as MDpocketAnalyze """
+    return singleLinkageClusters(SparseGrid(sparseFile).getIsoCoords(isoValue), maxDist)
+
+
+def runBenchmark(isoValue=1.0):
+    results = []
+    with tempfile.TemporaryDirectory() as workDir:
+        for edge, nBlobs in BLOB_SIZES:
+            sparseFile = writeSparseGrid(os.path.join(workDir, 'grid_{}.npz'.format(edge)),
+                                         *syntheticDensityGrid(edge, nBlobs))
+            results.append(benchmarkGrid(sparseFile, isoValue))
+    return results
+
+
+def benchmarkGrid(sparseFile, isoValue):
+    clusters, protocolTime = timeIt(protocolClusters, sparseFile, isoValue, MAX_DIST)
+    coords = SparseGrid(sparseFile).getIsoCoords(isoValue)
+    _, cellTime = timeIt(singleLinkageClusters, coords, MAX_DIST)
+
+    pairTime, same = None, None
+    if len(coords) <= MAX_PAIRWISE_POINTS:
+        pairClusters, pairTime = timeIt(pairwiseClusters, coords.tolist(), MAX_DIST)
+        same = asClusterSets(pairClusters) == asClusterSets(clusters)
+
+    return {'nPoints': len(coords), 'nClusters': len(clusters), 'cellListTime': cellTime,
+            'protocolTime': protocolTime, 'pairwiseTime': pairTime, 'sameClusters': same}
+
+
+if __name__ == '__main__':
+    print('{:>10} {:>10} {:>14} {:>14} {:>18} {:>10} {:>8}'.format('Points', 'Clusters', 'Pairwise (s)',
+                                                                 'Cell list (s)', 'Protocol path (s)', 'Speedup',
+                                                                 'Same'))
+    for res in runBenchmark():
+        pairTime = '{:.4f}'.format(res['pairwiseTime']) if res['pairwiseTime'] is not None else '-'
+        speedup = '{:.1f}x'.format(res['pairwiseTime'] / res['cellListTime']) if res['pairwiseTime'] else '-'
+        print('{:>10} {:>10} {:>14} {:>14.4f} {:>18.4f} {:>10} {:>8}'.format(
+            res['nPoints'], res['nClusters'], pairTime, res['cellListTime'], res['protocolTime'], speedup,
+            str(res['sameClusters'])))
@@ -0,0 +1,262 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Offline benchmark suite of the Python hot paths of the plugin, on synthetic receptors, density grids, trajectories,
+mdpocket sphere files and descriptor tables generated at several scales (no dataset nor fpocket binaries needed).
+Results are written as JSON (stable layout, sorted keys) and can be compared with a baseline to catch regressions:
+
+    python -m fpocket.tests.benchmark_suite --scales small,medium --output results.json
+    python -m fpocket.tests.benchmark_suite --baseline results.json --tolerance 1.5
+"""
+
+import os, sys, json, time, platform, argparse, tempfile, struct
+import numpy as np
+
+from fpocket.constants import MDPOCKET_DESCRIPTORS, CONTACT_DIST, SPHERE_ASSIGN_DIST
+from fpocket.utils import readDXGrid, writeDXGrid, getIsoCoords, readPDBCoords, writePDBCoords, \
+    singleLinkageClusters, CellList, pointSetsContacts, writeDescriptorsFile, readDescriptorsFile, \
+    writeModifiedPocketFile, writeDescriptorsStore, readDescriptorColumn, convertDXToSparse, SparseGrid, \
+    readXtcFrameIndex, writeXtcFrames, splitXtcWindows, iterPDBModels, PDBModelsWriter, buildPointSetsIndex, \
+    assignToPointSets
+
+SCHEMA_VERSION = 2
+ISO_VALUE = 1.0
+MAX_INTRA_DIST = 2.0
+
+SPHERES_PER_FRAME = 60
+
+# gridEdge: voxels per side (1 A spacing), nBlobs: density blobs in the grid (sparsity), nAtoms: receptor atoms,
+# nSnapshots: rows of the descriptor tables, nFrames: frames of the trajectory and models of the mdpocket sphere file
+SCALES = {'small': {'gridEdge': 32, 'nBlobs': 10, 'nAtoms': 2000, 'nSnapshots': 1000, 'nFrames': 200},
+          'medium': {'gridEdge': 64, 'nBlobs': 40, 'nAtoms': 10000, 'nSnapshots': 10000, 'nFrames': 1000},
+          'large': {'gridEdge': 128, 'nBlobs': 150, 'nAtoms': 50000, 'nSnapshots': 100000, 'nFrames': 5000}}
+
+
+# ---------------------------------- Synthetic data -----------------------------------
+def syntheticDensityGrid(edge, nBlobs, seed=0):
+    """ Density grid made of gaussian blobs of random widths, as a mdpocket density grid. Each blob is only added
+    around its center, so large sparse grids are generated quickly """
+    rng = np.random.default_rng(seed)
+    grid = np.zeros((edge, edge, edge))
+    for center, width in zip(rng.uniform(0, edge, (nBlobs, 3)), rng.uniform(1.0, 3.0, nBlobs)):
+        lows = np.maximum(np.floor(center - 4 * width).astype(int), 0)
+        highs = np.minimum(np.ceil(center + 4 * width).astype(int) + 1, edge)
+        x, y, z = np.meshgrid(*[np.arange(low, high) for low, high in zip(lows, highs)], indexing='ij')
+        grid[lows[0]:highs[0], lows[1]:highs[1], lows[2]:highs[2]] += \
+            3 * np.exp(-((x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2) / (2 * width ** 2))
+    return grid, np.zeros(3), np.ones(3)
+
+
+def writeSyntheticReceptor(outFile, nAtoms, edge, seed=0):
+    """ Receptor PDB with atoms spread over the grid box """
+    coords = np.random.default_rng(seed).uniform(0, edge, (nAtoms, 3))
+    return writePDBCoords(outFile, coords, recName='ATOM', atomName='CA', resName='ALA', element='C')
+
+
+def writeSyntheticDescriptors(outFile, nSnapshots, seed=0):
+    """ Descriptors table with all the mdpocket columns """
+    rng = np.random.default_rng(seed)
+    descDic = {'snapshot': np.arange(1, nSnapshots + 1)}
+    for name in MDPOCKET_DESCRIPTORS:
+        descDic[name] = rng.integers(0, 100, nSnapshots) if name == 'nb_AS' else rng.uniform(0, 500, nSnapshots)
+    return writeDescriptorsFile(outFile, descDic)
+
+
+def writeSyntheticTrajectory(outFile, nFrames, nAtoms, seed=0):
+    """ XTC trajectory with the frame layout of compressed coordinates (about 4 bytes per atom). The payloads are
+    random bytes, as the trajectory is only indexed, sliced and split by frames, never decoded """
+    rng = np.random.default_rng(seed)
+    with open(outFile, 'wb') as f:
+        for step in range(nFrames):
+            nBytes = int(4 * nAtoms + rng.integers(0, 64))
+            f.write(struct.pack('>iiif', 1995, nAtoms, step, 0.1 * step) + struct.pack('>9f', *np.eye(3).ravel() * 10))
+            f.write(struct.pack('>if3i3iii', nAtoms, 1000.0, 0, 0, 0, 100, 100, 100, 0, nBytes))
+            f.write(rng.integers(0, 256, nBytes + (-nBytes % 4), dtype=np.uint8).tobytes())
+    return outFile
+
+
+def writeSyntheticSpheres(outFile, pocketSets, nFrames, seed=0):
+    """ Multi-model PDB with the alpha sphere centers of each snapshot spread around the pocket points, as the
+    mdpout_mdpocket.pdb of a single pass mdpocket run """
+    rng = np.random.default_rng(seed)
+    allPoints = np.concatenate(pocketSets)
+    fmt = 'ATOM  %5d    C STP     1    %8.3f%8.3f%8.3f  0.00  0.00          Ve'
+    with open(outFile, 'w') as f:
+        for model in range(nFrames):
+            coords = allPoints[rng.integers(0, len(allPoints), SPHERES_PER_FRAME)] + \
+                     rng.normal(0, 1.0, (SPHERES_PER_FRAME, 3))
+            f.write('MODEL {:>8}\n'.format(model + 1))
+            np.savetxt(f, np.column_stack([np.arange(1, SPHERES_PER_FRAME + 1), coords]), fmt=fmt)
+            f.write('ENDMDL\n')
+        f.write('END\n')
+    return outFile
+
+
+def splitSpheres(spheresFile, pocketSets, outDir):
+    """ Split of the spheres of a single pass run by pocket, as MDpocketCharacterize.splitPocketsStep """
+    index = buildPointSetsIndex(pocketSets, maxDist=SPHERE_ASSIGN_DIST)
+    writers = [PDBModelsWriter(os.path.join(outDir, 'spheres_{}.pdb'.format(i))) for i in range(len(pocketSets))]
+    nModels = 0
+    for firstModel, nBlockModels, lines, coords, models in iterPDBModels(spheresFile):
+        labels = assignToPointSets(coords, index)
+        for i, writer in enumerate(writers):
+            idxs = np.where(labels == i)[0]
+            writer.write(lines[idxs], firstModel + models[idxs])
+        nModels = firstModel + nBlockModels
+    return [writer.close(nModels) for writer in writers]
+
+
+def isoPockets(sparseFile, isoValue, maxDist):
+    """ Grid points over the isovalue clustered into pockets, as MDpocketAnalyze.selIsovalue + buildPocketsSet """
+    return singleLinkageClusters(SparseGrid(sparseFile).getIsoCoords(isoValue), maxDist)
+
+
+# ---------------------------------- Benchmarks -----------------------------------
+def timeIt(func, repeat):
+    """ Best wall time of repeat calls of func, and its last result """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def benchmarkScale(scale, workDir, repeat=3):
+    """ Times the hot paths on the synthetic data of a scale. Returns a list of result dictionaries """
+    params = SCALES[scale]
+    edge = params['gridEdge']
+    dxFile = writeDXGrid(os.path.join(workDir, 'dens_grid.dx'),
+                         *syntheticDensityGrid(edge, params['nBlobs']))
+    receptorFile = writeSyntheticReceptor(os.path.join(workDir, 'receptor.pdb'), params['nAtoms'], edge)
+    descFile = writeSyntheticDescriptors(os.path.join(workDir, 'descriptors.txt'), params['nSnapshots'])
+
+    benchmarks = {}
+    benchmarks['readDXGrid'] = lambda: readDXGrid(dxFile, useCache=False)
+    readDXGrid(dxFile)
+    benchmarks['readDXGridCached'] = lambda: readDXGrid(dxFile)
+
+    sparseFile = convertDXToSparse(dxFile)
+    benchmarks['readSparseGrid'] = lambda: SparseGrid(sparseFile).toDense()
+    benchmarks['sparseIsoCoords'] = lambda: SparseGrid(sparseFile).getIsoCoords(ISO_VALUE)
+
+    grid, origin, delta = readDXGrid(dxFile)
+    benchmarks['getIsoCoords'] = lambda: getIsoCoords(grid, origin, delta, ISO_VALUE)
+    coords = getIsoCoords(grid, origin, delta, ISO_VALUE)
+    pdbFile = writePDBCoords(os.path.join(workDir, 'isoCoords.pdb'), coords)
+    benchmarks['readPDBCoords'] = lambda: readPDBCoords(pdbFile)
+
+    benchmarks['clustering'] = lambda: singleLinkageClusters(coords, MAX_INTRA_DIST)
+    #Whole path of the analysis protocol, from the stored sparse grid to the pockets
+    benchmarks['isoPockets'] = lambda: isoPockets(sparseFile, ISO_VALUE, MAX_INTRA_DIST)
+    clusters = singleLinkageClusters(coords, MAX_INTRA_DIST)
+    pocketsDir = os.path.join(workDir, 'pockets')
+    os.makedirs(pocketsDir, exist_ok=True)
+    benchmarks['createPocketFile'] = lambda: [writePDBCoords(os.path.join(pocketsDir, 'pocketFile_{}.pdb'.format(i)),
+                                                             clust) for i, clust in enumerate(clusters)]
+    pocketFiles = benchmarks['createPocketFile']()
+    benchmarks['createPocketFileModified'] = lambda: [writeModifiedPocketFile(
+        pocketFile, pocketFile.replace('pocketFile_', 'pocketFile_Modified_')) for pocketFile in pocketFiles]
+
+    benchmarks['contacts'] = lambda: pointSetsContacts(clusters, CellList(readPDBCoords(receptorFile), CONTACT_DIST),
+                                                       CONTACT_DIST)
+    benchmarks['descriptorParsing'] = lambda: readDescriptorsFile(descFile)
+    writeDescriptorsStore(descFile)
+    benchmarks['descriptorColumnLoad'] = lambda: np.asarray(readDescriptorColumn(descFile, 'pock_volume')).sum()
+
+    trajFile = writeSyntheticTrajectory(os.path.join(workDir, 'trajectory.xtc'), params['nFrames'],
+                                        params['nAtoms'])
+    benchmarks['xtcFrameIndex'] = lambda: readXtcFrameIndex(trajFile)
+    sliceIdxs = np.arange(0, params['nFrames'], 2)
+    benchmarks['xtcSlice'] = lambda: writeXtcFrames(trajFile, os.path.join(workDir, 'slice.xtc'), sliceIdxs)
+    windowsDir = os.path.join(workDir, 'windows')
+    os.makedirs(windowsDir, exist_ok=True)
+    benchmarks['xtcWindows'] = lambda: splitXtcWindows(trajFile, windowsDir, 4)
+
+    spheresFile = writeSyntheticSpheres(os.path.join(workDir, 'mdpout_mdpocket.pdb'), clusters, params['nFrames'])
+    splitDir = os.path.join(workDir, 'split')
+    os.makedirs(splitDir, exist_ok=True)
+    benchmarks['splitSpheres'] = lambda: splitSpheres(spheresFile, clusters, splitDir)
+
+    sizes = {'isoPoints': len(coords), 'pockets': len(clusters), 'dxBytes': os.path.getsize(dxFile),
+             'sparseBytes': os.path.getsize(sparseFile), 'xtcBytes': os.path.getsize(trajFile),
+             'spheresBytes': os.path.getsize(spheresFile)}
+    results = []
+    for name, func in benchmarks.items():
+        seconds, _ = timeIt(func, repeat)
+        results.append({'benchmark': name, 'scale': scale, 'params': dict(params, **sizes),
+                        'seconds': round(seconds, 6), 'repeat': repeat})
+    return results
+
+
+def runSuite(scales=('small', 'medium'), repeat=3):
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory(prefix='fpocketBench_') as workDir:
+            results += benchmarkScale(scale, workDir, repeat)
+    results.sort(key=lambda res: (res['benchmark'], list(SCALES).index(res['scale'])))
+    return {'schema': SCHEMA_VERSION, 'suite': 'fpocket-python-hotpaths',
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'platform': platform.platform(), 'machine': platform.machine()},
+            'results': results}
+
+
+def findRegressions(report, baseline, tolerance=1.5):
+    """ Benchmarks slower than tolerance times their baseline time. Returns a list of (benchmark, scale, ratio) """
+    baseTimes = {(res['benchmark'], res['scale']): res['seconds'] for res in baseline['results']}
+    regressions = []
+    for res in report['results']:
+        baseTime = baseTimes.get((res['benchmark'], res['scale']))
+        if baseTime and res['seconds'] > tolerance * baseTime:
+            regressions.append((res['benchmark'], res['scale'], res['seconds'] / baseTime))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the Python hot paths of scipion-chem-fpocket')
+    parser.add_argument('--scales', default='small,medium', help='Comma separated scales: {}'.format(', '.join(SCALES)))
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of each benchmark (best time is kept)')
+    parser.add_argument('--output', help='JSON file to write the results into')
+    parser.add_argument('--baseline', help='JSON results to compare with. Exits with error if there are regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Max allowed slowdown ratio against the baseline')
+    args = parser.parse_args()
+
+    report = runSuite([scale.strip() for scale in args.scales.split(',')], args.repeat)
+    print('{:>26} {:>8} {:>12} {:>10}'.format('Benchmark', 'Scale', 'Seconds', 'Points'))
+    for res in report['results']:
+        print('{:>26} {:>8} {:>12.5f} {:>10}'.format(res['benchmark'], res['scale'], res['seconds'],
+                                                     res['params']['isoPoints']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = findRegressions(report, json.load(f), args.tolerance)
+        for name, scale, ratio in regressions:
+            print('REGRESSION: {} ({}) is {:.2f}x slower than the baseline'.format(name, scale, ratio))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,122 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, sys, json, time, shutil, tempfile, subprocess, unittest
+
+from fpocket.jobs import Job, JobRunner, ProgressMonitor
+
+
+def pythonJob(code, name=None, monitor=None):
+    return Job(sys.executable, ['-c', code], name=name, monitor=monitor)
+
+
+class TestJobRunner(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.runner = JobRunner(maxJobs=4, log=self.lines.append)
+
+    def testConcurrency(self):
+        jobs = [pythonJob('import time; time.sleep(0.5)', name=str(i)) for i in range(3)]
+        start = time.perf_counter()
+        self.runner.run(jobs)
+        self.assertLess(time.perf_counter() - start, 1.4)
+
+        start = time.perf_counter()
+        self.runner.run(jobs, maxJobs=1)
+        self.assertGreaterEqual(time.perf_counter() - start, 1.5)
+
+    def testProcessWideSlots(self):
+        self.assertIs(JobRunner(maxJobs=4).slots, self.runner.slots)
+        self.assertIsNot(JobRunner(maxJobs=2).slots, self.runner.slots)
+
+    def testOutput(self):
+        self.runner.run([pythonJob('print("pocket 1"); print("done\\rrewritten")', name='job1')])
+        self.assertIn('[job1] pocket 1', self.lines)
+        self.assertIn('[job1] done', self.lines)
+        self.assertIn('[job1] rewritten', self.lines)
+
+    def testErrors(self):
+        jobs = [pythonJob('pass'), pythonJob('import sys; sys.exit(3)'), pythonJob('pass')]
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.runner.run(jobs)
+        self.assertEqual(cm.exception.returncode, 3)
+
+    def testOnDone(self):
+        jobs = [pythonJob('import sys; sys.exit({})'.format(i % 2), name=str(i)) for i in range(4)]
+        done = {}
+        #Failed jobs are only reported to onDone
+        self.runner.run(jobs, onDone=lambda job, error: done.update({job.name: error}))
+        self.assertEqual(sorted(done), ['0', '1', '2', '3'])
+        self.assertIsNone(done['0'])
+        self.assertIsInstance(done['1'], subprocess.CalledProcessError)
+
+
+class TestProgressMonitor(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testProgressLines(self):
+        monitor = ProgressMonitor(totalFrames=100)
+        monitor.start(os.getpid(), log=lambda line: None)
+        self.assertTrue(monitor.update('Processing snapshot 10 / 100'))
+        self.assertTrue(monitor.update('snapshot 5'))
+        self.assertFalse(monitor.update('Reading receptor'))
+        stats = monitor.getStats()
+        self.assertEqual(stats['framesDone'], 10)
+        self.assertIsNotNone(stats['eta'])
+        self.assertIn('Frames 10/100', ProgressMonitor.formatStats(stats))
+
+    def testTimelineBound(self):
+        monitor = ProgressMonitor(logInterval=1, maxTimeline=10)
+        for i in range(25):
+            monitor.addTimelinePoint({'elapsed': i})
+        self.assertLessEqual(len(monitor.timeline), 10)
+        self.assertEqual(monitor.timeline[0]['elapsed'], 0)
+        #Every other point is dropped each time it gets full (at the 11th, 16th and 21st points), doubling the
+        # interval between points
+        self.assertEqual(monitor.timelineInterval, 8)
+
+    def testMonitoredJob(self):
+        timelineFile = os.path.join(self.tmpDir, 'timeline.json')
+        monitor = ProgressMonitor(totalFrames=3, timelineFile=timelineFile, logInterval=0.1, sampleInterval=0.05)
+        lines = []
+        code = 'import time\nfor i in range(1, 4):\n    print("snapshot", i, flush=True)\n    time.sleep(0.1)'
+        JobRunner(maxJobs=1, log=lines.append).run([pythonJob(code, monitor=monitor)])
+
+        with open(timelineFile) as f:
+            timeline = json.load(f)
+        self.assertEqual(timeline['summary']['framesDone'], 3)
+        self.assertGreater(timeline['summary']['peakRssMB'], 0)
+        self.assertTrue(timeline['timeline'])
+        #Progress lines are summarized by the monitor instead of logged
+        self.assertFalse([line for line in lines if line.startswith('snapshot')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,467 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, shutil, struct, tempfile, unittest
+import numpy as np
+
+from fpocket.utils import mergeGrids, readXtcFrameIndex, writeXtcFrames, splitXtcWindows, parseValuesList, \
+    readPDBCoords, iterPDBModels, PDBModelsWriter, writePDBCoords, readDXGrid, writeDXGrid, getIsoCoords, \
+    writeSparseGrid, convertDXToSparse, SparseGrid, ensureDXGrid, downsampleGrid, writeGridPyramid, \
+    ensureDXGridLevel, getGridLevelFile, ResultsCache, StepProfiler, computeDescriptorStats, computeOpenFraction, \
+    minMaxEnvelope, reduceSeries, writeDescriptorsFile, writeDescriptorsStore, readDescriptorColumn, \
+    getDescriptorNames, getDescriptorReduction
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def getPath(self, name):
+        return os.path.join(self.tmpDir, name)
+
+    def writeText(self, name, text):
+        with open(self.getPath(name), 'w') as f:
+            f.write(text)
+        return self.getPath(name)
+
+    def readText(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+
+class TestPDBCoords(TempDirTestCase):
+    def testTouchingColumns(self):
+        #Coordinates over -100 fill their 8 columns, so they are not separated by spaces
+        pdbFile = self.writeText('touching.pdb',
+                                 'REMARK header\n'
+                                 'HETATM    1 APOL STP C   1    -123.456-100.123-999.999  0.00  0.00          Ve\n'
+                                 'TER\n'
+                                 'ATOM      2  CA  ALA A   2       1.000   2.000   3.000  1.00  0.00           C\n'
+                                 'END\n')
+        np.testing.assert_allclose(readPDBCoords(pdbFile), [[-123.456, -100.123, -999.999], [1, 2, 3]], atol=1e-3)
+
+    def testShortLines(self):
+        #Records cut before the end of the z column are parsed by their fields
+        pdbFile = self.writeText('short.pdb',
+                                 'ATOM      1 C    STP     1      10.000  20.000  30.0\n'
+                                 'ATOM      2 C    STP     1 4.0 5.0 6.0\n'
+                                 'ATOM      3 C    STP     1       7.000   8.000   9.000\n')
+        np.testing.assert_allclose(readPDBCoords(pdbFile), [[10, 20, 30], [4, 5, 6], [7, 8, 9]])
+
+    def testWriteRoundTrip(self):
+        coords = np.random.default_rng(0).uniform(-50, 50, (20, 3))
+        np.testing.assert_allclose(readPDBCoords(writePDBCoords(self.getPath('coords.pdb'), coords)), coords,
+                                   atol=1e-3)
+
+
+class TestPDBModels(TempDirTestCase):
+    """ Multi-model PDB files read in blocks of whole models, whatever the block size """
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        #Models with different number of records, including empty ones
+        self.nRecords = [3, 0, 5, 1, 0, 0, 4, 2]
+        self.coords = [rng.uniform(-10, 10, (n, 3)) for n in self.nRecords]
+        lines = ['REMARK mdpocket output']
+        for i, coords in enumerate(self.coords):
+            lines.append('MODEL {:>8}'.format(i + 1))
+            lines += ['ATOM  {:5d} C    STP     1    {:8.3f}{:8.3f}{:8.3f}  0.00  0.00'.format(j + 1, *coord)
+                      for j, coord in enumerate(coords)]
+            lines.append('ENDMDL')
+        self.pdbFile = self.writeText('models.pdb', '\n'.join(lines + ['END']) + '\n')
+
+    def _readAll(self, blockSize):
+        records, coords, models, nModels = [], [], [], 0
+        for firstModel, nBlockModels, bRecords, bCoords, bModels in iterPDBModels(self.pdbFile, blockSize):
+            self.assertEqual(firstModel, nModels)
+            records.append(bRecords)
+            coords.append(bCoords)
+            models.append(firstModel + bModels)
+            nModels += nBlockModels
+        return np.concatenate(records), np.concatenate(coords), np.concatenate(models), nModels
+
+    def testBlockSizes(self):
+        expectedModels = np.repeat(np.arange(len(self.nRecords)), self.nRecords)
+        for blockSize in [1, 7, 64, 200, 2 ** 20]:
+            records, coords, models, nModels = self._readAll(blockSize)
+            self.assertEqual(nModels, len(self.nRecords))
+            np.testing.assert_array_equal(models, expectedModels)
+            np.testing.assert_allclose(coords, np.concatenate(self.coords), atol=1e-3)
+            self.assertEqual(len(records), sum(self.nRecords))
+
+    def testWithoutModels(self):
+        pdbFile = writePDBCoords(self.getPath('single.pdb'), self.coords[0])
+        blocks = list(iterPDBModels(pdbFile))
+        self.assertEqual(len(blocks), 1)
+        firstModel, nModels, _, coords, models = blocks[0]
+        self.assertEqual((firstModel, nModels), (0, 1))
+        np.testing.assert_array_equal(models, [0, 0, 0])
+
+    def testWriterRoundTrip(self):
+        records, _, models, nModels = self._readAll(64)
+        writer = PDBModelsWriter(self.getPath('copy.pdb'))
+        #Written in two parts, as the blocks of a streamed split
+        half = len(records) // 2
+        writer.write(records[:half], models[:half])
+        writer.write(records[half:], models[half:])
+        outFile = writer.close(nModels)
+
+        expected = [line for line in self.readText(self.pdbFile).splitlines() if not line.startswith('REMARK')]
+        self.assertEqual(self.readText(outFile).splitlines(), expected)
+
+    def testWriterEmpty(self):
+        self.assertEqual(self.readText(PDBModelsWriter(self.getPath('empty.pdb')).close(0)), 'END\n')
+        outFile = PDBModelsWriter(self.getPath('emptyModels.pdb')).close(2)
+        self.assertEqual(self.readText(outFile).split(), ['MODEL', '1', 'ENDMDL', 'MODEL', '2', 'ENDMDL', 'END'])
+
+
+class TestGrids(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.grid = np.where(rng.random((7, 6, 5)) > 0.7, rng.uniform(0.1, 5, (7, 6, 5)).round(3), 0.0)
+        self.origin, self.delta = np.array([-2.5, 1.0, 30.25]), np.array([1.0, 1.0, 1.0])
+        self.dxFile = writeDXGrid(self.getPath('grid.dx'), self.grid, self.origin, self.delta)
+
+    def testDXRoundTrip(self):
+        for useCache in [True, True, False]:
+            grid, origin, delta = readDXGrid(self.dxFile, useCache=useCache)
+            np.testing.assert_allclose(grid, self.grid)
+            np.testing.assert_allclose(origin, self.origin)
+            np.testing.assert_allclose(delta, self.delta)
+        self.assertTrue(os.path.exists(self.dxFile + '.npz'))
+
+    def testSparseRoundTrip(self):
+        sparseFile = convertDXToSparse(self.dxFile, removeDX=True)
+        self.assertFalse(os.path.exists(self.dxFile))
+        sparse = SparseGrid(sparseFile)
+        self.assertEqual(sparse.shape, self.grid.shape)
+        np.testing.assert_allclose(sparse.toDense(), self.grid, rtol=1e-6)
+
+        #The DX file is exported back from the sparse grid
+        grid, origin, delta = readDXGrid(ensureDXGrid(self.dxFile), useCache=False)
+        np.testing.assert_allclose(grid, self.grid, rtol=1e-6)
+        np.testing.assert_allclose(origin, self.origin)
+        np.testing.assert_allclose(delta, self.delta)
+
+    def testIsoCoords(self):
+        sparse = SparseGrid(writeSparseGrid(self.getPath('grid.npz'), self.grid, self.origin, self.delta))
+        for isoValue in [0, 1.0, 2.5, 10]:
+            np.testing.assert_allclose(sparse.getIsoCoords(isoValue),
+                                       getIsoCoords(self.grid, self.origin, self.delta, isoValue))
+
+    def testDownsample(self):
+        grid, origin, delta = downsampleGrid(self.grid, self.origin, self.delta, 2)
+        self.assertEqual(grid.shape, (4, 3, 3))
+        #Max pooling: each coarse voxel keeps the maximum of its block (border blocks are partial)
+        self.assertEqual(grid[0, 0, 0], self.grid[:2, :2, :2].max())
+        self.assertEqual(grid[3, 2, 2], self.grid[6:, 4:, 4:].max())
+        self.assertEqual(grid.max(), self.grid.max())
+        np.testing.assert_allclose(origin, self.origin + 0.5)
+        np.testing.assert_allclose(delta, 2 * self.delta)
+
+    def testPyramid(self):
+        sparseFiles = writeGridPyramid(self.dxFile, factors=(2, 4))
+        self.assertEqual(sparseFiles, [getGridLevelFile(self.dxFile, factor, '.sparse.npz') for factor in (2, 4)])
+        levelFile = ensureDXGridLevel(self.dxFile, 4)
+        self.assertEqual(levelFile, getGridLevelFile(self.dxFile, 4))
+        grid, origin, _ = readDXGrid(levelFile, useCache=False)
+        expected, expOrigin, _ = downsampleGrid(self.grid, self.origin, self.delta, 4)
+        np.testing.assert_allclose(grid, expected, rtol=1e-6)
+        np.testing.assert_allclose(origin, expOrigin)
+        self.assertEqual(ensureDXGridLevel(self.dxFile, 1), self.dxFile)
+
+    def testLevelWithoutPyramid(self):
+        levelFile = ensureDXGridLevel(self.dxFile, 2)
+        np.testing.assert_allclose(readDXGrid(levelFile, useCache=False)[0],
+                                   downsampleGrid(self.grid, self.origin, self.delta, 2)[0], rtol=1e-6)
+
+
+class TestResultsCache(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = ResultsCache(self.getPath('cache'), maxSize=250)
+        self.resultsDir = self.getPath('results')
+        os.makedirs(os.path.join(self.resultsDir, 'pockets'))
+        self.writeText('results/out.txt', 'a' * 100)
+        self.writeText('results/pockets/pocket1.pdb', 'b' * 20)
+        self.paths = [os.path.join(self.resultsDir, 'out.txt'), os.path.join(self.resultsDir, 'pockets')]
+
+    def testStoreRestore(self):
+        self.assertFalse(self.cache.restore('key1', self.getPath('restored')))
+        self.cache.store('key1', self.paths)
+        self.assertTrue(self.cache.restore('key1', self.getPath('restored')))
+        self.assertEqual(self.readText(self.getPath('restored/out.txt')), 'a' * 100)
+        self.assertEqual(self.readText(self.getPath('restored/pockets/pocket1.pdb')), 'b' * 20)
+
+    def testCopiesAreIndependent(self):
+        self.cache.store('key1', self.paths)
+        #Changing the stored or the restored files does not change the cached ones
+        self.writeText('results/out.txt', 'changed')
+        self.cache.restore('key1', self.getPath('restored'))
+        self.writeText('restored/out.txt', 'changed')
+        self.assertEqual(self.readText(os.path.join(self.cache.getEntryDir('key1'), 'out.txt')), 'a' * 100)
+
+    def testEvictLeastRecentlyUsed(self):
+        for key in ['key1', 'key2']:
+            self.cache.store(key, self.paths)
+        #key1 is used again, so key2 is the least recently used entry when key3 overflows the cache
+        self.cache.restore('key1', self.getPath('restored'))
+        self.cache.store('key3', self.paths)
+        self.assertTrue(os.path.isdir(self.cache.getEntryDir('key1')))
+        self.assertFalse(os.path.isdir(self.cache.getEntryDir('key2')))
+        self.assertTrue(os.path.isdir(self.cache.getEntryDir('key3')))
+        with open(self.cache.getIndexFile()) as f:
+            self.assertEqual(sorted(json.load(f)), ['key1', 'key3'])
+
+    def testDeferredEviction(self):
+        for key in ['key1', 'key2', 'key3']:
+            self.cache.store(key, self.paths, evict=False)
+        self.assertEqual(len([name for name in os.listdir(self.cache.cacheDir) if name.startswith('key')]), 3)
+        self.cache.evict()
+        self.assertEqual(sorted(name for name in os.listdir(self.cache.cacheDir) if name.startswith('key')),
+                         ['key2', 'key3'])
+
+    def testFileHashMemo(self):
+        inpFile = self.writeText('input.pdb', 'ATOM')
+        fHash = self.cache.fileHash(inpFile)
+        self.assertEqual(self.cache.fileHash(inpFile), fHash)
+        with open(self.cache.getMemoFile()) as f:
+            self.assertEqual(list(json.load(f).values()), [fHash])
+
+        #Hashes of removed files are pruned on eviction
+        os.remove(inpFile)
+        self.cache.evict()
+        with open(self.cache.getMemoFile()) as f:
+            self.assertEqual(json.load(f), {})
+
+
+class TestStepProfiler(TempDirTestCase):
+    def testNestedSections(self):
+        profiler = StepProfiler(self.getPath('profile.json'))
+        with profiler.section('outer'):
+            with profiler.section('mdpocket', kind='binary'):
+                sum(range(10 ** 6))
+            with open(self.getPath('data.bin'), 'wb') as f:
+                f.write(b'0' * 10 ** 5)
+
+        inner, outer = profiler.getRecords()
+        self.assertEqual((inner['section'], inner['kind']), ('mdpocket', 'binary'))
+        self.assertEqual((outer['section'], outer['kind']), ('outer', 'python'))
+        for field in ['wallTime', 'cpuTime', 'bytesRead', 'bytesWritten']:
+            self.assertGreaterEqual(outer[field], 0)
+        #The time of the inner section is not counted in the outer one
+        self.assertLess(outer['cpuTime'], inner['cpuTime'])
+        summary = profiler.getSummary()
+        self.assertIn('running fpocket/mdpocket', summary)
+
+    def testDisabled(self):
+        profiler = StepProfiler(self.getPath('profile.json'), enabled=False)
+        with profiler.section('outer'):
+            pass
+        self.assertEqual(profiler.getRecords(), [])
+        self.assertIsNone(profiler.getSummary())
+
+
+class TestDescriptors(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        n = 500
+        self.descDic = {'snapshot': np.arange(1, n + 1), 'nb_AS': rng.integers(0, 20, n).astype(float),
+                        'pock_volume': rng.uniform(0, 500, n).round(4)}
+        self.descFile = writeDescriptorsFile(self.getPath('descriptors.txt'), self.descDic)
+
+    def testStats(self):
+        stats = computeDescriptorStats(self.descDic)
+        self.assertEqual(sorted(stats), ['nb_AS', 'pock_volume'])
+        volumes = self.descDic['pock_volume']
+        self.assertAlmostEqual(stats['pock_volume']['mean'], volumes.mean())
+        self.assertAlmostEqual(stats['pock_volume']['median'], np.median(volumes))
+        self.assertAlmostEqual(stats['pock_volume']['p95'], np.percentile(volumes, 95))
+        #Uncorrelated snapshots have an autocorrelation time close to 1
+        self.assertLess(abs(stats['pock_volume']['acTime'] - 1), 0.5)
+        self.assertEqual(computeDescriptorStats({'snapshot': [], 'nb_AS': []}), {'nb_AS': {}})
+        self.assertAlmostEqual(computeOpenFraction(self.descDic), np.mean(self.descDic['nb_AS'] > 0))
+
+    def testColumnarStore(self):
+        self.assertEqual(getDescriptorNames(self.descFile), list(self.descDic))
+        np.testing.assert_allclose(readDescriptorColumn(self.descFile, 'pock_volume'), self.descDic['pock_volume'])
+        self.assertIsNone(readDescriptorColumn(self.descFile, 'missing'))
+        self.assertEqual(getDescriptorNames(self.descFile), list(self.descDic))
+
+        #An outdated store is rebuilt
+        newDic = dict(self.descDic, nb_AS=self.descDic['nb_AS'] + 1)
+        writeDescriptorsFile(self.descFile, newDic)
+        os.utime(self.descFile, ns=(0, 0))
+        np.testing.assert_allclose(readDescriptorColumn(self.descFile, 'nb_AS'), newDic['nb_AS'])
+        self.assertTrue(os.path.isdir(writeDescriptorsStore(self.descFile)))
+
+    def testReduceSeries(self):
+        x, y = self.descDic['snapshot'], self.descDic['pock_volume']
+        xBins, yMin, yMax = minMaxEnvelope(x, y, 50)
+        self.assertEqual(len(xBins), 50)
+        #The envelope keeps the extremes of the series
+        self.assertEqual(yMin.min(), y.min())
+        self.assertEqual(yMax.max(), y.max())
+        np.testing.assert_allclose(yMax[0], y[:10].max())
+
+        reduction = reduceSeries(x, y, nBins=50, window=10)
+        self.assertEqual(reduction['window'], 10)
+        for key in ['x', 'min', 'max', 'mean', 'std']:
+            self.assertEqual(len(reduction[key]), 50)
+        self.assertTrue(np.all((reduction['min'] <= reduction['max'])))
+        #Rolling mean of the window centered at the middle of the second bin (snapshot index 14)
+        np.testing.assert_allclose(reduction['mean'][1], y[9:19].mean())
+
+        #Series shorter than the number of bins are kept whole
+        xBins, yMin, yMax = minMaxEnvelope(x[:10], y[:10], 50)
+        np.testing.assert_allclose(yMin, y[:10])
+
+        cached = getDescriptorReduction(self.descFile, 'pock_volume', nBins=50, window=10)
+        np.testing.assert_allclose(cached['max'], reduction['max'])
+        np.testing.assert_allclose(getDescriptorReduction(self.descFile, 'pock_volume', nBins=50, window=10)['mean'],
+                                   reduction['mean'])
+
+
+class TestMergeGrids(unittest.TestCase):
+    """ Merging per window grids must give the grid of the whole trajectory """
+    def _windowGrid(self, frames, origin, delta):
+        # Mean over the window frames, cropped to the voxels visited by them as mdpocket does
+        grid = np.mean(frames, axis=0)
+        nonZero = np.argwhere(grid > 0)
+        lo, hi = nonZero.min(axis=0), nonZero.max(axis=0) + 1
+        return grid[tuple(slice(l, h) for l, h in zip(lo, hi))], origin + lo * delta, delta
+
+    def testSerialGrid(self):
+        rng = np.random.default_rng(0)
+        origin, delta = np.array([-3.0, 1.5, 10.0]), np.array([1.0, 1.0, 1.0])
+        frames = np.zeros((30, 12, 10, 8))
+        for i, frame in enumerate(frames):
+            #Pocket drifting along the trajectory, so each window has a different extent
+            frame[i // 5: i // 5 + 4, 2:7, 1:5] = rng.random((4, 5, 4))
+        serialGrid = frames.mean(axis=0)
+
+        windows = [frames[:7], frames[7:19], frames[19:]]
+        grids = [self._windowGrid(win, origin, delta) for win in windows]
+        merged, mOrigin, mDelta = mergeGrids(grids, [len(win) for win in windows])
+
+        lo = np.round((mOrigin - origin) / delta).astype(int)
+        expected = serialGrid[tuple(slice(l, l + n) for l, n in zip(lo, merged.shape))]
+        np.testing.assert_allclose(merged, expected)
+        np.testing.assert_allclose(mDelta, delta)
+        self.assertAlmostEqual(serialGrid.sum(), merged.sum())
+
+    def testMisalignedGrids(self):
+        #A linear field is exactly recovered by the trilinear resampling of a grid shifted by a fraction of voxel
+        delta = np.array([0.5, 0.5, 0.5])
+        field = lambda x, y, z: 1 + 2 * x - y + 0.5 * z
+        coords = np.indices((6, 6, 6)).transpose(1, 2, 3, 0) * delta
+        originA, originB = np.zeros(3), np.array([0.2, 0.1, 0.35])
+        gridA, gridB = field(*(coords + originA).T).T, field(*(coords + originB).T).T
+
+        merged, origin, _ = mergeGrids([(gridA, originA, delta), (gridB, originB, delta)], [1, 1])
+        np.testing.assert_allclose(origin, originA)
+        self.assertEqual(merged.shape, (7, 7, 7))
+        #Voxels inside both grids
+        inner = merged[1:6, 1:6, 1:6]
+        np.testing.assert_allclose(inner, field(*(coords[1:6, 1:6, 1:6] + originA).T).T, atol=1e-12)
+
+    def testDifferentSpacing(self):
+        grid = np.ones((2, 2, 2))
+        with self.assertRaises(ValueError):
+            mergeGrids([(grid, np.zeros(3), np.ones(3)), (grid, np.zeros(3), 2 * np.ones(3))], [1, 1])
+
+
+class TestXtcFrames(unittest.TestCase):
+    """ Frames of a synthetic XTC trajectory, with uncompressed (up to 9 atoms) and compressed frames of both
+    magic numbers. Compressed payloads are random bytes, as the frames are indexed and copied without decoding """
+    def _frameBytes(self, step, nAtoms, magic=1995, nBytes=0):
+        header = struct.pack('>iiif', magic, nAtoms, step, 0.1 * step) + struct.pack('>9f', *np.eye(3).ravel())
+        header += struct.pack('>i', nAtoms)
+        if nAtoms <= 9:
+            return header + struct.pack('>{}f'.format(3 * nAtoms), *np.arange(3 * nAtoms, dtype=float))
+        header += struct.pack('>f3i3ii', 1000.0, 0, 0, 0, 10, 10, 10, 0)
+        header += struct.pack('>i' if magic == 1995 else '>q', nBytes)
+        return header + os.urandom(nBytes) + b'\0' * (-nBytes % 4)
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.frames = [self._frameBytes(0, 5), self._frameBytes(1, 5), self._frameBytes(2, 20, nBytes=13),
+                       self._frameBytes(3, 20, nBytes=16), self._frameBytes(4, 20, magic=2023, nBytes=7)]
+        self.xtcFile = os.path.join(self.tmpDir, 'traj.xtc')
+        with open(self.xtcFile, 'wb') as f:
+            f.write(b''.join(self.frames))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def testFrameIndex(self):
+        offsets, sizes = readXtcFrameIndex(self.xtcFile)
+        self.assertEqual(len(offsets), len(self.frames))
+        np.testing.assert_array_equal(sizes, [len(frame) for frame in self.frames])
+        np.testing.assert_array_equal(offsets, np.cumsum([0] + [len(frame) for frame in self.frames[:-1]]))
+
+    def testSliceRoundTrip(self):
+        frameIdxs = [0, 2, 3]
+        outFile = writeXtcFrames(self.xtcFile, os.path.join(self.tmpDir, 'slice.xtc'), frameIdxs)
+        self.assertEqual(self._read(outFile), b''.join(self.frames[i] for i in frameIdxs))
+        self.assertEqual(len(readXtcFrameIndex(outFile)[0]), len(frameIdxs))
+
+    def testWindows(self):
+        windows = splitXtcWindows(self.xtcFile, self.tmpDir, 2)
+        self.assertEqual([nFrames for _, nFrames in windows], [3, 2])
+        self.assertEqual(b''.join(self._read(winFile) for winFile, _ in windows), self._read(self.xtcFile))
+
+    def testBadMagic(self):
+        badFile = os.path.join(self.tmpDir, 'bad.xtc')
+        with open(badFile, 'wb') as f:
+            f.write(b'\0' * 100)
+        with self.assertRaises(ValueError):
+            readXtcFrameIndex(badFile)
+
+
+class TestParseValuesList(unittest.TestCase):
+    def testValues(self):
+        self.assertEqual(parseValuesList('0.5, 2:3:0.5'), [0.5, 2.0, 2.5, 3.0])
+        self.assertEqual(parseValuesList('1:1:1; 4'), [1.0, 4.0])
+        self.assertEqual(parseValuesList(''), [])
+
+    def testInvalidRanges(self):
+        for valuesStr in ['1:2:0', '1:2:-0.5', '3:1:1', '1:2', 'a', 'nan', 'inf', '-inf', '0:inf:1', '0:1:nan']:
+            with self.assertRaises(ValueError):
+                parseValuesList(valuesStr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1289 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *           Lobna Ramadane Morchadi (lobna.ramadane@alumnos.upm.es)
+# * Biocomputing Unit, CNB-CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Utility functions shared by the fpocket protocols and viewers
+"""
+
+import os, shutil, hashlib, threading, json, struct, errno, tempfile, time, math
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    #Unix only: file locks of the results cache and resource usage of the profiler
+    import fcntl, resource
+except ImportError:
+    fcntl, resource = None, None
+
+
+# ---------------------------------- Staging -----------------------------------
+def linkFile(inFile, outFile):
+    """ Makes inFile available as outFile without copying its content when possible.
+    Tries a symbolic link, then a hard link and only copies the file as a last resort.
+    Returns the absolute path of outFile. """
+    inFile, outFile = os.path.abspath(inFile), os.path.abspath(outFile)
+    if os.path.lexists(outFile):
+        if os.path.realpath(outFile) == os.path.realpath(inFile):
+            return outFile
+        os.remove(outFile)
+
+    try:
+        os.symlink(inFile, outFile)
+    except OSError:
+        try:
+            os.link(inFile, outFile)
+        except OSError:
+            shutil.copy(inFile, outFile)
+    return outFile
+
+
+def stageFiles(inFiles, outDir):
+    """ Links the input files into outDir (see linkFile) and returns the list of staged paths """
+    os.makedirs(outDir, exist_ok=True)
+    return [linkFile(inFile, os.path.join(outDir, os.path.basename(inFile))) for inFile in inFiles]
+
+
+def makeScratchDir(scratchRoot, prefix):
+    """ Creates a unique directory inside scratchRoot (e.g. a node-local disk or tmpfs) and returns its path """
+    os.makedirs(scratchRoot, exist_ok=True)
+    return tempfile.mkdtemp(prefix=prefix, dir=scratchRoot)
+
+
+def moveResults(srcDir, outDir):
+    """ Moves the content of srcDir into outDir. Each entry appears atomically in outDir: it is renamed when both
+    directories share filesystem, or copied with a temporary name and then renamed otherwise.
+    Returns the list of moved paths """
+    os.makedirs(outDir, exist_ok=True)
+    moved = []
+    for name in os.listdir(srcDir):
+        src, dst = os.path.join(srcDir, name), os.path.join(outDir, name)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        try:
+            os.replace(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            tmpDst = os.path.join(outDir, '.{}.{}.tmp'.format(name, os.getpid()))
+            shutil.move(src, tmpDst)
+            os.replace(tmpDst, dst)
+        moved.append(dst)
+    return moved
+
+
+# ---------------------------------- PDB files -----------------------------------
+PDB_LINE_WIDTH = 80
+
+
+def _readPDBRecords(pdbFile):
+    """ Reads the lines of a PDB file into a fixed width bytes array.
+    Returns the lines array, the mask of ATOM/HETATM records and the mask of MODEL lines """
+    with open(pdbFile, 'rb') as f:
+        lines = np.array(f.read().splitlines(), dtype='S{}'.format(PDB_LINE_WIDTH))
+    isRecord = np.char.startswith(lines, b'ATOM') | np.char.startswith(lines, b'HETATM')
+    return lines, isRecord, np.char.startswith(lines, b'MODEL')
+
+
+def _parseRecordsCoords(records):
+    """ Parses the x, y, z fixed columns (31-54) of an array of PDB records into a (n x 3) float32 array.
+    Lines shorter than 80 columns are padded with spaces. Records whose fixed columns are not numbers (as lines
+    cut before column 54) are parsed by their whitespace separated fields, as x, y, z after the residue number """
+    columns = np.ascontiguousarray(records.view('S1').reshape(-1, PDB_LINE_WIDTH)[:, 30:54])
+    columns[columns == b''] = b' '
+    fields = columns.view('S8').reshape(-1, 3)
+    try:
+        return fields.astype(np.float32)
+    except ValueError:
+        coords = np.zeros(fields.shape, dtype=np.float32)
+        for i, (record, recordFields) in enumerate(zip(records, fields)):
+            try:
+                coords[i] = recordFields.astype(np.float32)
+            except ValueError:
+                coords[i] = [float(v) for v in record.split()[5:8]]
+        return coords
+
+
+def readPDBCoords(pdbFile):
+    """ Reads the coordinates of the ATOM/HETATM records of a PDB file as a (n x 3) float32 array.
+    Coordinates are parsed in bulk by their fixed columns, so touching columns and REMARK/TER/END lines are
+    handled correctly """
+    lines, isRecord, _ = _readPDBRecords(pdbFile)
+    return _parseRecordsCoords(lines[isRecord])
+
+
+def iterPDBModels(pdbFile, blockSize=2 ** 24):
+    """ Reads the ATOM/HETATM records of a (multi-model) PDB file in blocks of whole models of about blockSize
+    bytes, so only a block is in memory at a time.
+    Yields, for each block, the index of its first model, its number of models, the record lines (bytes array),
+    their coordinates (n x 3) and the index (in the block) of the model each record belongs to """
+    firstModel, pending = 0, b''
+    with open(pdbFile, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            data = pending + block
+            if block:
+                #Blocks are cut before the last MODEL line, so every model is read in a single block (and the lines
+                # before the first MODEL line go with it)
+                cut = data.rfind(b'\nMODEL') + 1
+                if firstModel == 0 and not data.startswith(b'MODEL') and cut == data.find(b'\nMODEL') + 1:
+                    cut = 0
+                if cut == 0:
+                    pending = data
+                    continue
+            elif not data:
+                break
+            else:
+                cut = len(data)
+            data, pending = data[:cut], data[cut:]
+
+            lines = np.array(data.splitlines(), dtype='S{}'.format(PDB_LINE_WIDTH))
+            isRecord = np.char.startswith(lines, b'ATOM') | np.char.startswith(lines, b'HETATM')
+            isModel = np.char.startswith(lines, b'MODEL')
+            nModels = int(isModel.sum())
+            if firstModel == 0:
+                #Records before the first MODEL line (or files without models) belong to the first model
+                nModels = max(nModels, 1)
+                models = np.maximum(np.cumsum(isModel)[isRecord] - 1, 0)
+            else:
+                models = np.cumsum(isModel)[isRecord] - 1
+            records = lines[isRecord]
+            if nModels > 0:
+                yield firstModel, nModels, records, _parseRecordsCoords(records), models
+            firstModel += nModels
+            if not block:
+                break
+
+
+def writePDBCoords(outFile, coords, recName='HETATM', atomName='APOL', resName='STP', element='Ve'):
+    """ Writes the coordinates as the records of a PDB file (as the pocket files), formatting them in bulk """
+    fmt = '{:<6}%5d {:^4} {:>3} C   1    %8.3f%8.3f%8.3f  1.00  0.00          {:>2}'.format(
+        recName, atomName, resName, element)
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    table = np.column_stack([np.arange(1, len(coords) + 1), coords])
+    with open(outFile, 'w') as f:
+        np.savetxt(f, table, fmt=fmt)
+        f.write('END\n')
+    return outFile
+
+
+def writeModifiedPocketFile(pocketFile, outFile):
+    """ Writes the pocket file with the records renamed as mdpocket expects them in a selected pocket
+    (pocket spheres as protein ATOM records) """
+    with open(pocketFile) as f:
+        text = f.read()
+    #The replacements never cross lines, so they are applied to the whole file at once
+    for check, rep in zip(("HETATM", "APOL", "C", "STP", "Ve"), ("ATOM  ", "", "PTH  ", "C  ", "C  ")):
+        text = text.replace(check, rep)
+    with open(outFile, 'w') as f:
+        f.write(text)
+    return outFile
+
+
+class PDBModelsWriter:
+    """ Writes records into a multi-model PDB file as they come, model after model. Empty models are also written,
+    so the number of frames is kept """
+    def __init__(self, outFile):
+        self.outFile = outFile
+        self.f = open(outFile, 'wb')
+        self.nModels = 0
+
+    def write(self, lines, models):
+        """ Writes the record lines (bytes) in their model index. Models must not be lower than the ones already
+        written """
+        models = np.asarray(models)
+        order = np.argsort(models, kind='stable')
+        lines, models = np.asarray(lines)[order], models[order]
+        starts = np.searchsorted(models, np.unique(models))
+        for model, start, end in zip(models[starts], starts, np.r_[starts[1:], len(models)].astype(int)):
+            self.openModel(model)
+            self.f.write(b'\n'.join(lines[start:end]) + b'\n')
+
+    def openModel(self, model):
+        """ Closes the models written so far and opens (after empty ones if needed) the model with index model """
+        while self.nModels <= model:
+            if self.nModels > 0:
+                self.f.write(b'ENDMDL\n')
+            self.nModels += 1
+            self.f.write('MODEL {:>8}\n'.format(self.nModels).encode())
+
+    def close(self, nModels):
+        """ Writes the missing empty models up to nModels and closes the file """
+        if nModels > 0:
+            self.openModel(nModels - 1)
+            self.f.write(b'ENDMDL\n')
+        self.f.write(b'END\n')
+        self.f.close()
+        return self.outFile
+
+
+# ---------------------------------- Point sets -----------------------------------
+def buildPointSetsIndex(pointSets, maxDist):
+    """ Builds a CellList of the points of all the point sets, so many coordinates can be assigned afterwards to the
+    point set with the closest point within maxDist. Returns the index, the point set of each point and maxDist """
+    allPoints = np.concatenate(pointSets).reshape(-1, 3)
+    setIdxs = np.repeat(np.arange(len(pointSets)), [len(pSet) for pSet in pointSets])
+    return CellList(allPoints, maxDist), setIdxs, maxDist
+
+
+def assignToPointSets(coords, pointSetsIndex):
+    """ Returns, for each coordinate, the index of the point set with the closest point (exact distances) in the
+    pointSetsIndex built with buildPointSetsIndex (-1 if no point is closer than its maxDist) """
+    cellList, setIdxs, maxDist = pointSetsIndex
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    assigned = np.full(len(coords), -1, dtype=int)
+    qIdxs, pIdxs = cellList.queryPairs(coords, maxDist)
+    if len(qIdxs) > 0:
+        dists = np.sum((coords[qIdxs] - cellList.coords[pIdxs]) ** 2, axis=1)
+        order = np.lexsort((dists, qIdxs))
+        qIdxs, pIdxs = qIdxs[order], pIdxs[order]
+        first = np.ones(len(qIdxs), dtype=bool)
+        first[1:] = qIdxs[1:] != qIdxs[:-1]
+        assigned[qIdxs[first]] = setIdxs[pIdxs[first]]
+    return assigned
+
+
+# ---------------------------------- Descriptors -----------------------------------
+def computeSphereDescriptors(coords, models, nModels):
+    """ Computes, for each model (snapshot), the pocket descriptors that can be derived from the alpha sphere
+    centers alone: number of alpha spheres, alpha sphere density (mean distance between alpha sphere pairs)
+    and maximum distance between the mass center and the alpha spheres.
+    Returns a dictionary {mdpocketColumnName: values} """
+    nbAS = np.bincount(models, minlength=nModels).astype(float)
+    centers = np.stack([np.bincount(models, weights=coords[:, i], minlength=nModels) for i in range(3)],
+                       axis=1).astype(float)
+    centers /= np.maximum(nbAS, 1)[:, None]
+
+    maxDists = np.zeros(nModels)
+    np.maximum.at(maxDists, models, np.linalg.norm(coords - centers[models], axis=1))
+
+    densities = np.zeros(nModels)
+    order = np.argsort(models, kind='stable')
+    bounds = np.searchsorted(models[order], np.arange(nModels + 1))
+    for i in np.where(nbAS > 1)[0]:
+        mCoords = coords[order[bounds[i]:bounds[i + 1]]]
+        dists = np.linalg.norm(mCoords[:, None, :] - mCoords[None, :, :], axis=-1)
+        densities[i] = dists.sum() / (len(mCoords) * (len(mCoords) - 1))
+
+    return {'snapshot': np.arange(1, nModels + 1), 'nb_AS': nbAS, 'as_density': densities,
+            'as_max_dst': maxDists}
+
+
+def writeDescriptorsFile(outFile, descDic):
+    """ Writes a descriptors table with the same layout as the mdpocket one (header line with the descriptor
+    names followed by one line per snapshot) """
+    names = list(descDic.keys())
+    table = np.stack([np.asarray(descDic[name], dtype=float) for name in names], axis=1)
+    fmts = ['%d' if name in ('snapshot', 'nb_AS') else '%.4f' for name in names]
+    np.savetxt(outFile, table, fmt=fmts, delimiter=' ', header=' '.join(names), comments='')
+    return outFile
+
+
+def readDescriptorsFile(descFile):
+    """ Reads a mdpocket descriptors table (header line with the descriptor names followed by one line per
+    snapshot). Returns a dictionary {descriptorName: float array} """
+    with open(descFile) as f:
+        names = f.readline().split()
+        table = np.loadtxt(f, dtype=float, ndmin=2).reshape(-1, len(names))
+    return {name: table[:, i] for i, name in enumerate(names)}
+
+
+def getDescriptorsStoreDir(descFile):
+    return os.path.splitext(descFile)[0] + '_columns'
+
+
+def writeDescriptorsStore(descFile):
+    """ Converts a descriptors table into a columnar store: one .npy file per descriptor (memory mappable) in
+    <descFile>_columns, with a columns.json index. Returns the store directory """
+    storeDir = getDescriptorsStoreDir(descFile)
+    os.makedirs(storeDir, exist_ok=True)
+    descDic = readDescriptorsFile(descFile)
+    for i, (name, values) in enumerate(descDic.items()):
+        np.save(os.path.join(storeDir, 'column_{}.npy'.format(i)), np.ascontiguousarray(values))
+
+    stats = os.stat(descFile)
+    with open(os.path.join(storeDir, 'columns.json'), 'w') as f:
+        json.dump({'columns': list(descDic.keys()), 'nRows': len(next(iter(descDic.values()), [])),
+                   'srcSize': stats.st_size, 'srcMtime': stats.st_mtime_ns}, f)
+    return storeDir
+
+
+def _readDescriptorsIndex(descFile):
+    """ Index of the columnar store of the descriptors file, None if missing or older than the file """
+    indexFile = os.path.join(getDescriptorsStoreDir(descFile), 'columns.json')
+    if not os.path.exists(indexFile):
+        return None
+    with open(indexFile) as f:
+        index = json.load(f)
+    stats = os.stat(descFile)
+    if index['srcSize'] != stats.st_size or index['srcMtime'] != stats.st_mtime_ns:
+        return None
+    return index
+
+
+def getDescriptorNames(descFile):
+    """ Names of the descriptors (columns) of a descriptors table """
+    index = _readDescriptorsIndex(descFile)
+    if index is None:
+        with open(descFile) as f:
+            return f.readline().split()
+    return index['columns']
+
+
+def readDescriptorColumn(descFile, name):
+    """ Values of a single descriptor, memory mapped from the columnar store (without reading the other columns).
+    The store is created if it is missing or outdated. Returns None if the descriptor is not in the table """
+    index = _readDescriptorsIndex(descFile)
+    if index is None:
+        writeDescriptorsStore(descFile)
+        index = _readDescriptorsIndex(descFile)
+    if name not in index['columns']:
+        return None
+    columnFile = os.path.join(getDescriptorsStoreDir(descFile), 'column_{}.npy'.format(index['columns'].index(name)))
+    return np.load(columnFile, mmap_mode='r')
+
+
+def autocorrelationTimes(table):
+    """ Integrated autocorrelation time (in snapshots) of each column of a (nSnapshots x nDescriptors) table, summing
+    its normalized autocorrelation (computed by FFT) up to the first non positive value. Constant columns get 0 """
+    table = np.asarray(table, dtype=float)
+    n = len(table)
+    centered = table - table.mean(axis=0)
+    nFFT = 2 ** int(np.ceil(np.log2(max(2 * n, 1))))
+    spectrum = np.fft.rfft(centered, n=nFFT, axis=0)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), n=nFFT, axis=0)[:n]
+    variances = acf[0]
+    acf = acf / np.where(variances > 0, variances, 1)
+    positive = np.cumprod(acf[1:] > 0, axis=0)
+    times = 1 + 2 * (acf[1:] * positive).sum(axis=0)
+    return np.where(variances > 0, times, 0.0)
+
+
+def computeDescriptorStats(descDic):
+    """ Summary statistics of every descriptor along the snapshots, computed at once over the descriptors table:
+    mean, std, percentiles 5, 25, 50 (median), 75 and 95 and autocorrelation time.
+    Returns a dictionary {descriptorName: {statistic: value}} (the snapshot column is skipped) """
+    names = [name for name in descDic if name != 'snapshot']
+    if not names:
+        return {}
+    table = np.stack([np.asarray(descDic[name], dtype=float) for name in names], axis=1)
+    if len(table) == 0:
+        return {name: {} for name in names}
+
+    stats = {'mean': table.mean(axis=0), 'std': table.std(axis=0), 'acTime': autocorrelationTimes(table)}
+    for statName, values in zip(['p5', 'p25', 'median', 'p75', 'p95'],
+                                np.percentile(table, [5, 25, 50, 75, 95], axis=0)):
+        stats[statName] = values
+    return {name: {statName: float(values[i]) for statName, values in stats.items()} for i, name in enumerate(names)}
+
+
+def computeOpenFraction(descDic):
+    """ Fraction of the snapshots where the pocket is open (with any alpha sphere) """
+    for name in ['nb_AS', 'pock_volume']:
+        if name in descDic and len(descDic[name]) > 0:
+            return float(np.mean(np.asarray(descDic[name]) > 0))
+    return None
+
+
+# ---------------------------------- Series reduction -----------------------------------
+def minMaxEnvelope(x, y, nBins):
+    """ Reduces a series to nBins bins of consecutive points, keeping for each bin its middle x and the min and
+    max y, so peaks are preserved when plotting it at screen resolution.
+    Returns the arrays (xBins, yMin, yMax) """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    edges = np.unique(np.linspace(0, len(y), min(nBins, len(y)) + 1).astype(int))
+    starts, ends = edges[:-1], edges[1:]
+    return x[(starts + ends - 1) // 2], np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)
+
+
+def rollingMeanStd(y, window):
+    """ Centered rolling mean and standard deviation of the series (window clipped at the ends), in linear time
+    from cumulative sums """
+    y = np.asarray(y, dtype=float)
+    sums, sqSums = np.r_[0, np.cumsum(y)], np.r_[0, np.cumsum(y * y)]
+    idxs = np.arange(len(y))
+    lows, highs = np.maximum(idxs - window // 2, 0), np.minimum(idxs + window - window // 2, len(y))
+    counts = highs - lows
+    means = (sums[highs] - sums[lows]) / counts
+    stds = np.sqrt(np.maximum((sqSums[highs] - sqSums[lows]) / counts - means ** 2, 0))
+    return means, stds
+
+
+def reduceSeries(x, y, nBins=2000, window=None):
+    """ Screen resolution summary of a series: min/max envelope over nBins bins and rolling mean/std (window of
+    0.5% of the points by default) sampled at the middle of each bin. Returns a dictionary of arrays """
+    y = np.asarray(y, dtype=float)
+    window = window if window else max(len(y) // 200, 1)
+    xBins, yMin, yMax = minMaxEnvelope(x, y, nBins)
+    means, stds = rollingMeanStd(y, window)
+    edges = np.unique(np.linspace(0, len(y), min(nBins, len(y)) + 1).astype(int))
+    mids = (edges[:-1] + edges[1:] - 1) // 2
+    return {'x': xBins, 'min': yMin, 'max': yMax, 'mean': means[mids], 'std': stds[mids], 'window': window}
+
+
+def getDescriptorReduction(descFile, name, nBins=2000, window=None):
+    """ Reduction of a descriptor series against the snapshots (see reduceSeries), cached in the columnar store of
+    the descriptors file so it is computed only once. Returns None if the descriptor is not in the table """
+    values = readDescriptorColumn(descFile, name)
+    if values is None:
+        return None
+    index = _readDescriptorsIndex(descFile)
+    redFile = os.path.join(getDescriptorsStoreDir(descFile), 'reduction_{}_{}_{}.npz'.
+                           format(index['columns'].index(name), nBins, window or 'auto'))
+    if os.path.exists(redFile):
+        with np.load(redFile) as red:
+            if red['srcMtime'] == index['srcMtime']:
+                return {key: red[key] for key in red.files if key != 'srcMtime'}
+
+    reduction = reduceSeries(readDescriptorColumn(descFile, index['columns'][0]), values, nBins, window)
+    np.savez(redFile, srcMtime=index['srcMtime'], **reduction)
+    return reduction
+
+
+# ---------------------------------- DX grids -----------------------------------
+def readDXGrid(dxFile, useCache=True):
+    """ Reads an OpenDX volumetric file (as the mdpout_*_grid.dx of mdpocket).
+    Returns the grid values as a (nx, ny, nz) array, the origin and the spacing (delta) of the grid.
+    A binary sidecar (<dxFile>.npz) is stored so that later loads of the same file skip the text parsing """
+    cacheFile = dxFile + '.npz'
+    stats = os.stat(dxFile)
+    if useCache and os.path.exists(cacheFile):
+        with np.load(cacheFile) as cache:
+            if cache['srcSize'] == stats.st_size and cache['srcMtime'] == stats.st_mtime_ns:
+                return cache['grid'], cache['origin'], cache['delta']
+
+    counts, origin, deltas = None, None, []
+    with open(dxFile) as f:
+        for line in f:
+            if line.startswith('object') and 'gridpositions' in line:
+                counts = tuple(int(n) for n in line.split()[-3:])
+            elif line.startswith('origin'):
+                origin = np.array(line.split()[1:4], dtype=float)
+            elif line.startswith('delta'):
+                deltas.append(np.array(line.split()[1:4], dtype=float))
+            elif 'data follows' in line:
+                break
+        #Values are read until the expected number of points, ignoring the trailing attribute lines
+        values = np.fromstring(f.read(), sep=' ', count=int(np.prod(counts)))
+
+    grid, delta = values.reshape(counts), np.abs(np.array(deltas)).sum(axis=1)
+    if useCache:
+        try:
+            with open(cacheFile, 'wb') as f:
+                np.savez(f, grid=grid, origin=origin, delta=delta,
+                         srcSize=stats.st_size, srcMtime=stats.st_mtime_ns)
+        except OSError:
+            pass
+    return grid, origin, delta
+
+
+def writeDXGrid(dxFile, grid, origin, delta, fmt='%.6g'):
+    """ Writes a (nx, ny, nz) grid with the given origin and spacing as an OpenDX volumetric file """
+    nx, ny, nz = grid.shape
+    header = 'object 1 class gridpositions counts {} {} {}\n'.format(nx, ny, nz)
+    header += 'origin {:.6f} {:.6f} {:.6f}\n'.format(*origin)
+    for i in range(3):
+        dVector = np.zeros(3)
+        dVector[i] = delta[i]
+        header += 'delta {:.6f} {:.6f} {:.6f}\n'.format(*dVector)
+    header += 'object 2 class gridconnections counts {} {} {}\n'.format(nx, ny, nz)
+    header += 'object 3 class array type double rank 0 items {} data follows\n'.format(grid.size)
+
+    values = np.ravel(grid)
+    nFull = len(values) - len(values) % 3
+    with open(dxFile, 'w') as f:
+        f.write(header)
+        np.savetxt(f, values[:nFull].reshape(-1, 3), fmt=fmt, delimiter=' ')
+        if nFull < len(values):
+            np.savetxt(f, values[nFull:].reshape(1, -1), fmt=fmt, delimiter=' ')
+        f.write('\nobject "Dataset" class field\n'
+                'component "positions" value 1\ncomponent "connections" value 2\ncomponent "data" value 3\n')
+    return dxFile
+
+
+def getGridCoords(voxels, origin, delta):
+    """ Returns the cartesian coordinates of the (n x 3) voxel indexes of a grid """
+    return (origin + np.asarray(voxels) * delta).astype(np.float32)
+
+
+def getIsoCoords(grid, origin, delta, isoValue):
+    """ Returns the coordinates of the grid points with a value over (or equal to) the isovalue """
+    return getGridCoords(np.argwhere(grid >= isoValue), origin, delta)
+
+
+# ---------------------------------- Sparse grids -----------------------------------
+def getSparseGridFile(dxFile):
+    return os.path.splitext(dxFile)[0] + '.sparse.npz'
+
+
+def writeSparseGrid(outFile, grid, origin, delta):
+    """ Stores the non zero voxels of a grid in a compressed binary file: gaps between their flat indexes (which
+    compress far better than the indexes) and their values, plus the grid shape, origin and spacing """
+    grid = np.asarray(grid)
+    flatIdxs = np.flatnonzero(grid)
+    gaps = np.diff(flatIdxs, prepend=0)
+    with open(outFile, 'wb') as f:
+        np.savez_compressed(f, shape=np.array(grid.shape), origin=np.asarray(origin, dtype=float),
+                            delta=np.asarray(delta, dtype=float), values=grid.ravel()[flatIdxs].astype(np.float32),
+                            gaps=gaps.astype(np.uint32 if grid.size < 2 ** 32 else np.uint64))
+    return outFile
+
+
+class SparseGrid:
+    """ Lazy loader of a sparse grid file (see writeSparseGrid): the header is read on creation and the voxels
+    only when they are first needed """
+    def __init__(self, sparseFile):
+        self.sparseFile = sparseFile
+        with np.load(sparseFile) as data:
+            self.shape, self.origin, self.delta = tuple(data['shape']), data['origin'], data['delta']
+        self._flatIdxs, self._values = None, None
+
+    def getVoxels(self):
+        """ Returns the flat indexes and values of the non zero voxels """
+        if self._flatIdxs is None:
+            with np.load(self.sparseFile) as data:
+                self._flatIdxs = np.cumsum(data['gaps'], dtype=np.int64)
+                self._values = data['values']
+        return self._flatIdxs, self._values
+
+    def toDense(self):
+        grid = np.zeros(self.shape)
+        flatIdxs, values = self.getVoxels()
+        grid.ravel()[flatIdxs] = values
+        return grid
+
+    def getIsoCoords(self, isoValue):
+        """ Coordinates of the voxels with a value over (or equal to) the isovalue, in the same order as getIsoCoords
+        on the dense grid """
+        if isoValue <= 0:
+            return getIsoCoords(self.toDense(), self.origin, self.delta, isoValue)
+        flatIdxs, values = self.getVoxels()
+        voxels = np.column_stack(np.unravel_index(flatIdxs[values >= isoValue], self.shape))
+        return getGridCoords(voxels.reshape(-1, 3), self.origin, self.delta)
+
+    def exportDX(self, dxFile):
+        return writeDXGrid(dxFile, self.toDense(), self.origin, self.delta)
+
+
+def convertDXToSparse(dxFile, removeDX=False):
+    """ Converts a DX grid into its sparse version (next to it). The DX file can then be removed, as it can be
+    exported back when needed (see ensureDXGrid). Returns the sparse file """
+    sparseFile = writeSparseGrid(getSparseGridFile(dxFile), *readDXGrid(dxFile, useCache=False))
+    if removeDX:
+        os.remove(dxFile)
+    return sparseFile
+
+
+def loadGrid(dxFile):
+    """ Loads a grid from its sparse version if available, or from the DX file otherwise.
+    Returns the dense grid, origin and spacing """
+    sparseFile = getSparseGridFile(dxFile)
+    if os.path.exists(sparseFile):
+        grid = SparseGrid(sparseFile)
+        return grid.toDense(), grid.origin, grid.delta
+    return readDXGrid(dxFile)
+
+
+def ensureDXGrid(dxFile):
+    """ Exports the DX file from its sparse version if it was removed. Returns the DX file """
+    if not os.path.exists(dxFile) and os.path.exists(getSparseGridFile(dxFile)):
+        SparseGrid(getSparseGridFile(dxFile)).exportDX(dxFile)
+    return dxFile
+
+
+# ---------------------------------- Grid pyramid -----------------------------------
+def downsampleGrid(grid, origin, delta, factor):
+    """ Coarser version of a grid, keeping the maximum of each block of factor^3 voxels (blocks at the borders
+    only take their voxels inside the grid). Max pooling keeps the peaks of the grid, so the isosurface of a
+    level at the same isovalue encloses the full resolution one and no small pocket vanishes from the coarse
+    levels. Returns the downsampled grid, origin (center of the first block) and spacing """
+    grid = np.asarray(grid, dtype=float)
+    shape = np.array(grid.shape)
+    newShape = -(-shape // factor)
+    pads = [(0, n * factor - s) for n, s in zip(newShape, shape)]
+    blocksShape = (newShape[0], factor, newShape[1], factor, newShape[2], factor)
+    maxs = np.pad(grid, pads, constant_values=-np.inf).reshape(blocksShape).max(axis=(1, 3, 5))
+    delta = np.asarray(delta, dtype=float)
+    return maxs, np.asarray(origin, dtype=float) + (factor - 1) / 2 * delta, delta * factor
+
+
+def getGridLevelFile(dxFile, factor, ext='.dx'):
+    """ File of the grid downsampled by factor (<dxFile>_x<factor>) """
+    return '{}_x{}{}'.format(os.path.splitext(dxFile)[0], factor, ext)
+
+
+def writeGridPyramid(dxFile, factors=(2, 4)):
+    """ Stores the grid downsampled by each factor as sparse files next to it. Returns their paths """
+    grid, origin, delta = loadGrid(dxFile)
+    return [writeSparseGrid(getGridLevelFile(dxFile, factor, '.sparse.npz'),
+                            *downsampleGrid(grid, origin, delta, factor)) for factor in factors]
+
+
+def ensureDXGridLevel(dxFile, factor=1):
+    """ DX file of the grid at the resolution level (downsampling factor), exporting it from the sparse pyramid
+    (or computing the level, if the pyramid was not stored) when it does not exist yet """
+    if factor == 1:
+        return ensureDXGrid(dxFile)
+    levelFile = getGridLevelFile(dxFile, factor)
+    if not os.path.exists(levelFile):
+        sparseFile = getGridLevelFile(dxFile, factor, '.sparse.npz')
+        if not os.path.exists(sparseFile):
+            writeGridPyramid(dxFile, factors=[factor])
+        SparseGrid(sparseFile).exportDX(levelFile)
+    return levelFile
+
+
+# ---------------------------------- Parameters -----------------------------------
+def _parseFinite(valueStr):
+    value = float(valueStr)
+    if not math.isfinite(value):
+        raise ValueError('"{}" is not a finite number'.format(valueStr.strip()))
+    return value
+
+
+def parseValuesList(valuesStr):
+    """ Parses a string of comma separated values and/or start:stop:step ranges (stop included) into a list of
+    floats, e.g: "0.5, 2:3:0.5" -> [0.5, 2.0, 2.5, 3.0]. Raises ValueError for values that are not finite numbers and
+    ranges without 3 fields, with a non positive step or with stop lower than start """
+    values = []
+    for item in (valuesStr or '').replace(';', ',').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            fields = item.split(':')
+            if len(fields) != 3:
+                raise ValueError('Range "{}" must be in the form start:stop:step'.format(item))
+            start, stop, step = (_parseFinite(v) for v in fields)
+            if step <= 0:
+                raise ValueError('Step of range "{}" must be positive'.format(item))
+            if stop < start:
+                raise ValueError('Stop of range "{}" must not be lower than its start'.format(item))
+            nSteps = int(np.floor((stop - start) / step + 1e-6)) + 1
+            values += [round(start + i * step, 6) for i in range(nSteps)]
+        else:
+            values.append(_parseFinite(item))
+    return values
+
+
+
+# ---------------------------------- Spatial index -----------------------------------
+def _expandRanges(starts, counts):
+    """ Returns the concatenation of the ranges [start, start + count) and the index of the range each
+    element comes from """
+    groups = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets, groups
+
+
+class CellList:
+    """ Spatial index of 3D points binned in cubic cells, used to find all the pairs of points closer than a
+    distance without comparing every pair """
+    _keyBits, _keyOffset = 21, 2 ** 20
+
+    def __init__(self, coords, cellSize):
+        if not cellSize > 0:
+            raise ValueError('The cell size must be positive (got {})'.format(cellSize))
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.cellSize = float(cellSize)
+        self.origin = self.coords.min(axis=0) if len(self.coords) > 0 else np.zeros(3)
+
+        keys = self._cellKeys(self._getCells(self.coords))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+    def _getCells(self, coords):
+        return np.floor((coords - self.origin) / self.cellSize).astype(np.int64)
+
+    def _cellKeys(self, cells):
+        cells = cells + self._keyOffset
+        return (cells[:, 0] << (2 * self._keyBits)) | (cells[:, 1] << self._keyBits) | cells[:, 2]
+
+    def queryPairs(self, queryCoords, maxDist, chunkSize=100000):
+        """ Returns the indexes (queryIdxs, pointIdxs) of all the pairs of query and indexed points closer
+        than maxDist """
+        queryCoords = np.asarray(queryCoords, dtype=float).reshape(-1, 3)
+        if len(self.keys) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        r = int(np.ceil(maxDist / self.cellSize))
+        offsets = np.stack(np.meshgrid(*[np.arange(-r, r + 1)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        qIdxs, pIdxs = [], []
+        for start in range(0, len(queryCoords), chunkSize):
+            qCoords = queryCoords[start:start + chunkSize]
+            qCells = self._getCells(qCoords)
+            for offset in offsets:
+                keys = self._cellKeys(qCells + offset)
+                pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+                found = np.where(self.keys[pos] == keys)[0]
+                if len(found) == 0:
+                    continue
+
+                sortedIdxs, groups = _expandRanges(self.starts[pos[found]], self.counts[pos[found]])
+                qIdx, pIdx = found[groups], self.order[sortedIdxs]
+                close = np.sum((qCoords[qIdx] - self.coords[pIdx]) ** 2, axis=1) < maxDist ** 2
+                qIdxs.append(qIdx[close] + start), pIdxs.append(pIdx[close])
+
+        if not qIdxs:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(qIdxs), np.concatenate(pIdxs)
+
+
+def connectedComponents(nNodes, iEdges, jEdges):
+    """ Labels the connected components of the graph defined by the edges (iEdges[k], jEdges[k]).
+    Returns, for each node, the smallest node index of its component """
+    labels = np.arange(nNodes)
+    while True:
+        newLabels = labels.copy()
+        minLabels = np.minimum(labels[iEdges], labels[jEdges])
+        np.minimum.at(newLabels, labels[iEdges], minLabels)
+        np.minimum.at(newLabels, labels[jEdges], minLabels)
+        #Pointer jumping until every node points to its root
+        while True:
+            jumped = newLabels[newLabels]
+            if np.array_equal(jumped, newLabels):
+                break
+            newLabels = jumped
+
+        if np.array_equal(newLabels, labels):
+            return labels
+        labels = newLabels
+
+
+def singleLinkageClusters(coords, maxDist):
+    """ Groups the coordinates in clusters where every point is closer than maxDist to at least another point of
+    its cluster (single linkage), using a cell list so the cost grows with n log n instead of n^2.
+    Returns a list with the (m x 3) arrays of coordinates of each cluster, in order of first appearance """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    if len(coords) == 0:
+        return []
+
+    iIdxs, jIdxs = CellList(coords, maxDist).queryPairs(coords, maxDist)
+    upper = iIdxs < jIdxs
+    labels = connectedComponents(len(coords), iIdxs[upper], jIdxs[upper])
+
+    order = np.argsort(labels, kind='stable')
+    _, starts = np.unique(labels[order], return_index=True)
+    return [coords[idxs] for idxs in np.split(order, starts[1:])]
+
+
+def groupOverlappingBoxes(boxMins, boxMaxs):
+    """ Groups the axis aligned boxes that overlap, directly or through other boxes.
+    Returns, for each box, the smallest box index of its group """
+    boxMins, boxMaxs = np.asarray(boxMins, dtype=float), np.asarray(boxMaxs, dtype=float)
+    overlaps = np.all((boxMins[:, None] <= boxMaxs[None]) & (boxMins[None] <= boxMaxs[:, None]), axis=2)
+    iEdges, jEdges = np.nonzero(np.triu(overlaps, 1))
+    return connectedComponents(len(boxMins), iEdges, jEdges)
+
+
+def pointSetsContacts(pointSets, atomsIndex, maxDist):
+    """ Finds, in a single batch query to the CellList of the receptor atoms, the atoms closer than maxDist to any
+    point of each of the point sets (pockets).
+    Returns a list with the sorted indexes of the contact atoms of each point set """
+    if len(pointSets) == 0:
+        return []
+    setIdxs = np.repeat(np.arange(len(pointSets)), [len(pSet) for pSet in pointSets])
+    pointIdxs, atomIdxs = atomsIndex.queryPairs(np.concatenate(pointSets).reshape(-1, 3), maxDist)
+
+    #Unique (set, atom) pairs, sorted by set and then by atom index
+    nAtoms = len(atomsIndex.coords)
+    pairs = np.unique(setIdxs[pointIdxs].astype(np.int64) * nAtoms + atomIdxs)
+    pairSets, pairAtoms = pairs // nAtoms, pairs % nAtoms
+    bounds = np.searchsorted(pairSets, np.arange(len(pointSets) + 1))
+    return [pairAtoms[bounds[i]:bounds[i + 1]] for i in range(len(pointSets))]
+
+
+# ---------------------------------- Trajectories -----------------------------------
+XTC_MAGICS = (1995, 2023)
+
+
+def readXtcFrameIndex(xtcFile):
+    """ Indexes the frames of an XTC trajectory reading only their headers (coordinates are not decompressed).
+    Returns the arrays of byte offsets and sizes of the frames """
+    offsets, sizes = [], []
+    fileSize = os.path.getsize(xtcFile)
+    with open(xtcFile, 'rb') as f:
+        pos = 0
+        while pos < fileSize:
+            f.seek(pos)
+            header = f.read(96)
+            magic, nAtoms = struct.unpack('>ii', header[:8])
+            if magic not in XTC_MAGICS:
+                raise ValueError('{} is not a valid XTC file (bad magic number at byte {})'.format(xtcFile, pos))
+
+            if nAtoms <= 9:
+                #Small systems are stored uncompressed
+                size = 56 + 12 * nAtoms
+            elif magic == 1995:
+                size = 92 + 4 * ((struct.unpack('>i', header[88:92])[0] + 3) // 4)
+            else:
+                size = 96 + 4 * ((struct.unpack('>q', header[88:96])[0] + 3) // 4)
+            offsets.append(pos), sizes.append(size)
+            pos += size
+    return np.array(offsets, dtype=np.int64), np.array(sizes, dtype=np.int64)
+
+
+def writeXtcFrames(xtcFile, outFile, frameIdxs, frameIndex=None, blockSize=2 ** 24):
+    """ Writes the selected frames of an XTC trajectory into outFile by copying their bytes, so no coordinate
+    decompression/compression is needed. Consecutive frames are copied as a single block """
+    offsets, sizes = readXtcFrameIndex(xtcFile) if frameIndex is None else frameIndex
+    frameIdxs = np.asarray(frameIdxs, dtype=int)
+    if len(frameIdxs) == 0:
+        open(outFile, 'wb').close()
+        return outFile
+
+    #Group consecutive frames in contiguous byte ranges
+    breaks = np.where(np.diff(frameIdxs) != 1)[0] + 1
+    firsts, lasts = frameIdxs[np.r_[0, breaks]], frameIdxs[np.r_[breaks - 1, len(frameIdxs) - 1]]
+    with open(xtcFile, 'rb') as fIn, open(outFile, 'wb') as fOut:
+        for first, last in zip(firsts, lasts):
+            fIn.seek(offsets[first])
+            remaining = offsets[last] + sizes[last] - offsets[first]
+            while remaining > 0:
+                block = fIn.read(min(blockSize, remaining))
+                fOut.write(block)
+                remaining -= len(block)
+    return outFile
+
+
+def splitXtcWindows(xtcFile, outDir, nWindows):
+    """ Splits an XTC trajectory into nWindows contiguous frame windows written in outDir.
+    Returns a list of (windowFile, nFrames) """
+    frameIndex = readXtcFrameIndex(xtcFile)
+    windows = []
+    for i, frameIdxs in enumerate(np.array_split(np.arange(len(frameIndex[0])), nWindows)):
+        if len(frameIdxs) > 0:
+            outFile = os.path.join(outDir, 'window_{}.xtc'.format(i + 1))
+            windows.append((writeXtcFrames(xtcFile, outFile, frameIdxs, frameIndex), len(frameIdxs)))
+    return windows
+
+
+def hasMDAnalysis():
+    """ MDAnalysis is an optional dependency, only needed to select atoms from the trajectories """
+    try:
+        import MDAnalysis
+        return True
+    except ImportError:
+        return False
+
+
+def writeAtomsSubset(sysFile, trajFile, selection, outSysFile, outTrajFile):
+    """ Writes the topology and trajectory of the atoms matching selection (MDAnalysis syntax, e.g. 'protein').
+    Returns the number of atoms kept """
+    import MDAnalysis as mda
+    system = mda.Universe(sysFile)
+    sysAtoms = system.select_atoms(selection)
+    if len(sysAtoms) == 0:
+        raise ValueError('No atoms match the selection "{}" in {}'.format(selection, sysFile))
+    #The topology keeps its own coordinates, not the ones of the first frame
+    sysAtoms.write(outSysFile)
+
+    universe = mda.Universe(sysFile, trajFile)
+    atoms = universe.atoms[sysAtoms.indices]
+    with mda.Writer(outTrajFile, n_atoms=len(atoms)) as writer:
+        for _ in universe.trajectory:
+            writer.write(atoms)
+    return len(atoms)
+
+
+# ---------------------------------- Grid operations -----------------------------------
+def shiftGrid(grid, shift):
+    """ Trilinear resampling of a grid at the points displaced by -shift voxels (each component in [0, 1)), so
+    its values fall on a lattice shifted by that fraction of voxel. The output has one more voxel in each shifted
+    axis and voxels out of the grid count as 0 """
+    for axis, frac in enumerate(shift):
+        if frac == 0:
+            continue
+        pad = [(0, 0)] * grid.ndim
+        pad[axis] = (1, 0)
+        before = np.pad(grid, pad)
+        pad[axis] = (0, 1)
+        grid = (1 - frac) * np.pad(grid, pad) + frac * before
+    return grid
+
+
+def mergeGrids(grids, weights, tol=1e-3):
+    """ Frame weighted mean of a list of (grid, origin, delta) grids with the same spacing, as mdpocket grids computed
+    over different windows of the same trajectory. Grids with different extents are placed in their union lattice
+    (voxels out of a grid count as 0 for its frames). Grids whose origin is not a whole number of voxels away from
+    the union origin (within tol voxels) are trilinearly resampled onto the union lattice.
+    Returns the merged (grid, origin, delta) """
+    delta = np.asarray(grids[0][2], dtype=float)
+    for _, _, gridDelta in grids[1:]:
+        if not np.allclose(gridDelta, delta):
+            raise ValueError('Grids with different spacings cannot be merged ({} and {})'.format(delta, gridDelta))
+
+    origins = np.array([origin for _, origin, _ in grids], dtype=float)
+    origin = origins.min(axis=0)
+    offsets = (origins - origin) / delta
+    starts = np.floor(offsets + tol).astype(int)
+    shifts = offsets - starts
+    shifts[np.abs(shifts) < tol] = 0
+
+    grids = [shiftGrid(grid, shift) for (grid, _, _), shift in zip(grids, shifts)]
+    shape = np.max([start + np.array(grid.shape) for grid, start in zip(grids, starts)], axis=0)
+    merged = np.zeros(shape)
+    for grid, start, weight in zip(grids, starts, weights):
+        merged[tuple(slice(st, st + n) for st, n in zip(start, grid.shape))] += weight * grid
+    return merged / np.sum(weights), origin, delta
+
+
+# ---------------------------------- Results cache -----------------------------------
+def hashFile(filename, blockSize=2 ** 22):
+    """ Returns the sha256 hex digest of the content of a file """
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def hashKey(*items):
+    """ Returns a sha256 hex digest identifying the sequence of items (strings, numbers or lists of them) """
+    hasher = hashlib.sha256()
+    for item in items:
+        item = [item] if not isinstance(item, (list, tuple)) else item
+        hasher.update(('\x1f'.join(str(i) for i in item) + '\x1e').encode())
+    return hasher.hexdigest()
+
+
+def getDirSize(path):
+    """ Returns the total size in bytes of the files under a directory """
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _copyIntoCache(src, dst):
+    # Cached files are independent copies, read only, so writing a protocol output never changes the cache
+    shutil.copy2(src, dst)
+    os.chmod(dst, 0o444)
+
+
+def _copyFromCache(src, dst):
+    # Restored files are writable copies, so writing them never changes the cache
+    if os.path.lexists(dst):
+        os.remove(dst)
+    shutil.copyfile(src, dst)
+
+
+class ResultsCache:
+    """ Content addressed cache of run results. Each entry is a directory named by its key (usually a hash of the
+    inputs and arguments of the run) and entries are evicted in least recently used order once the cache exceeds
+    maxSize bytes. The size and last access time of each entry are kept in an index file, so storing an entry does
+    not need to walk the whole cache, and every change to the entries is done holding a file lock shared by all the
+    runs using the cache. Files are copied in and out of the cache (cached copies are read only), so neither the
+    cache nor the protocol outputs can be modified through the other """
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = 'index.lock'
+    _threadLock = threading.RLock()
+
+    def __init__(self, cacheDir, maxSize):
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.maxSize = maxSize
+
+    def getEntryDir(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def getIndexFile(self):
+        return os.path.join(self.cacheDir, self.INDEX_FILE)
+
+    @contextmanager
+    def lock(self):
+        """ Holds the exclusive lock of the cache. Locks taken from different threads or processes exclude
+        each other """
+        os.makedirs(self.cacheDir, exist_ok=True)
+        if fcntl is None:
+            #Without file locks, only the threads of this process exclude each other
+            with self._threadLock:
+                yield
+            return
+
+        with open(os.path.join(self.cacheDir, self.LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _readIndex(self):
+        """ Returns the index {key: [size, accessTime]}. Built from the entry directories if it does not exist yet
+        or is unreadable. Must be called holding the lock """
+        try:
+            with open(self.getIndexFile()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        index = {}
+        for name in os.listdir(self.cacheDir):
+            entryDir = self.getEntryDir(name)
+            if '.tmp-' not in name and os.path.isdir(entryDir):
+                index[name] = [getDirSize(entryDir), os.path.getmtime(entryDir)]
+        return index
+
+    def _writeIndex(self, index):
+        tmpFile = '{}.tmp-{}-{}'.format(self.getIndexFile(), os.getpid(), threading.get_ident())
+        with open(tmpFile, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmpFile, self.getIndexFile())
+
+    def getMemoFile(self):
+        return os.path.join(self.cacheDir, 'fileHashes.json')
+
+    def _readMemo(self):
+        """ Returns the memoized file hashes {path:size:mtime: hash}. Must be called holding the lock """
+        try:
+            with open(self.getMemoFile()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeMemo(self, memo):
+        tmpFile = '{}.tmp-{}-{}'.format(self.getMemoFile(), os.getpid(), threading.get_ident())
+        with open(tmpFile, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmpFile, self.getMemoFile())
+
+    def fileHash(self, filename):
+        """ Returns the content hash of a file, memoized by path, size and modification time so big files
+        (as trajectories) are only read once """
+        stats = os.stat(filename)
+        fileId = '{}:{}:{}'.format(os.path.realpath(filename), stats.st_size, stats.st_mtime_ns)
+        with self.lock():
+            fHash = self._readMemo().get(fileId)
+        if fHash is None:
+            #Hashed out of the lock, as it can take a while for big files
+            fHash = hashFile(filename)
+            with self.lock():
+                memo = self._readMemo()
+                memo[fileId] = fHash
+                self._writeMemo(memo)
+        return fHash
+
+    def _pruneMemo(self):
+        """ Removes the memoized hashes of files that no longer exist or have changed. Must be called holding the
+        lock """
+        memo = self._readMemo()
+        valid = {}
+        for fileId, fHash in memo.items():
+            path, size, mtime = fileId.rsplit(':', 2)
+            try:
+                stats = os.stat(path)
+            except OSError:
+                continue
+            if '{}:{}'.format(stats.st_size, stats.st_mtime_ns) == '{}:{}'.format(size, mtime):
+                valid[fileId] = fHash
+        if len(valid) != len(memo):
+            self._writeMemo(valid)
+
+    def restore(self, key, outDir):
+        """ Places the files of the cache entry into outDir. Returns False if the entry does not exist.
+        Done holding the lock, so the entry cannot be evicted while its files are being copied """
+        entryDir = self.getEntryDir(key)
+        if not os.path.isdir(entryDir):
+            return False
+
+        with self.lock():
+            if not os.path.isdir(entryDir):
+                return False
+
+            os.makedirs(outDir, exist_ok=True)
+            for name in os.listdir(entryDir):
+                src, dst = os.path.join(entryDir, name), os.path.join(outDir, name)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst, copy_function=_copyFromCache, dirs_exist_ok=True)
+                else:
+                    _copyFromCache(src, dst)
+
+            index = self._readIndex()
+            index.setdefault(key, [getDirSize(entryDir), 0])[1] = time.time()
+            self._writeIndex(index)
+        return True
+
+    def store(self, key, paths, evict=True):
+        """ Stores the files and directories in paths as the cache entry key and evicts the oldest entries if the
+        cache gets bigger than its maximum size. When storing many entries in a row, evict can be set to False and
+        evict() called once at the end """
+        entryDir = self.getEntryDir(key)
+        if os.path.isdir(entryDir):
+            return entryDir
+
+        tmpDir = '{}.tmp-{}-{}'.format(entryDir, os.getpid(), threading.get_ident())
+        os.makedirs(tmpDir)
+        for path in paths:
+            dst = os.path.join(tmpDir, os.path.basename(os.path.normpath(path)))
+            if os.path.isdir(path):
+                shutil.copytree(path, dst, copy_function=_copyIntoCache)
+            else:
+                _copyIntoCache(path, dst)
+        size = getDirSize(tmpDir)
+
+        with self.lock():
+            try:
+                os.rename(tmpDir, entryDir)
+            except OSError:
+                #Entry stored concurrently by another run
+                shutil.rmtree(tmpDir, ignore_errors=True)
+            else:
+                index = self._readIndex()
+                index[key] = [size, time.time()]
+                self._writeIndex(index)
+
+        if evict:
+            self.evict()
+        return entryDir
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache size is under its maximum. Evicted entries are
+        renamed out of the cache holding the lock and deleted after releasing it """
+        toDelete = []
+        with self.lock():
+            index = self._readIndex()
+            totalSize = sum(size for size, _ in index.values())
+            for key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+                if totalSize <= self.maxSize:
+                    break
+                entryDir = self.getEntryDir(key)
+                trashDir = '{}.tmp-evict-{}-{}'.format(entryDir, os.getpid(), threading.get_ident())
+                try:
+                    os.rename(entryDir, trashDir)
+                    toDelete.append(trashDir)
+                except FileNotFoundError:
+                    pass
+                del index[key]
+                totalSize -= size
+            self._writeIndex(index)
+            self._pruneMemo()
+
+        for trashDir in toDelete:
+            shutil.rmtree(trashDir, ignore_errors=True)
+
+
+# ---------------------------------- Profiling -----------------------------------
+def _readProcIO():
+    """ Bytes read and written by the current process (rchar and wchar of /proc/self/io), (0, 0) if not available """
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(':') for line in f if ':' in line)
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _resourceUsage():
+    measure = {'wall': time.perf_counter(), 'cpu': time.thread_time(), 'time': time.time()}
+    measure['bytesRead'], measure['bytesWritten'] = _readProcIO()
+    if resource is not None:
+        selfUsage, childUsage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        measure.update({'childCpu': childUsage.ru_utime + childUsage.ru_stime,
+                        'childBytesRead': childUsage.ru_inblock * 512, 'childBytesWritten': childUsage.ru_oublock * 512,
+                        #ru_maxrss in KB (Linux): peak of the whole process life (of its largest waited child)
+                        'peakRss': selfUsage.ru_maxrss * 1024, 'childPeakRss': childUsage.ru_maxrss * 1024})
+    return measure
+
+
+class StepProfiler:
+    """
+    Records the wall time, CPU time, peak memory and bytes read/written of sections of a protocol into a JSON file.
+    The CPU time of the Python code is measured per thread, while the resources of the external programs (children)
+    and the I/O counters are process wide, so they are approximate when several steps run in parallel.
+    The OS only reports the peak memory of the whole process life (and of its largest finished child), so each
+    section records those peaks (processPeakRssMB, childProcessPeakRssMB) and how much the section raised them
+    (peakRssIncreaseMB, childPeakRssIncreaseMB; 0 if a previous section reached a higher peak).
+    When disabled, sections only run their code.
+    """
+    _lock = threading.Lock()
+    _deltas = {'wallTime': 'wall', 'cpuTime': 'cpu', 'bytesRead': 'bytesRead', 'bytesWritten': 'bytesWritten',
+               'childCpuTime': 'childCpu', 'childBytesRead': 'childBytesRead',
+               'childBytesWritten': 'childBytesWritten'}
+
+    def __init__(self, profileFile, enabled=True):
+        self.profileFile, self.enabled = profileFile, enabled
+        self._local = threading.local()
+
+    @contextmanager
+    def section(self, name, kind='python'):
+        """ Profiles the code of the with block. kind is 'python' or 'binary' (external program runs).
+        Sections can be nested (in the same thread): the time and I/O of the inner sections are not counted in the
+        outer ones, so no time is counted twice """
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._local.__dict__.setdefault('stack', [])
+        excluded = {field: 0 for field in self._deltas}
+        stack.append(excluded)
+        start = _resourceUsage()
+        try:
+            yield
+        finally:
+            end = _resourceUsage()
+            stack.pop()
+            deltas = {field: end[key] - start[key] for field, key in self._deltas.items() if key in end}
+            if stack:
+                for field, value in deltas.items():
+                    stack[-1][field] += value
+
+            record = {'section': name, 'kind': kind, 'start': round(start['time'], 3)}
+            for field, value in deltas.items():
+                value -= excluded[field]
+                record[field] = round(value, 4) if isinstance(value, float) else value
+            if resource is not None:
+                record.update({'processPeakRssMB': round(end['peakRss'] / 1024 ** 2, 1),
+                               'peakRssIncreaseMB': round((end['peakRss'] - start['peakRss']) / 1024 ** 2, 1),
+                               'childProcessPeakRssMB': round(end['childPeakRss'] / 1024 ** 2, 1),
+                               'childPeakRssIncreaseMB':
+                                   round((end['childPeakRss'] - start['childPeakRss']) / 1024 ** 2, 1)})
+            self.addRecord(record)
+
+    def addRecord(self, record):
+        with self._lock:
+            records = self.getRecords()
+            records.append(record)
+            tmpFile = self.profileFile + '.tmp'
+            with open(tmpFile, 'w') as f:
+                json.dump(records, f, indent=1)
+            os.replace(tmpFile, self.profileFile)
+
+    def getRecords(self):
+        if not os.path.exists(self.profileFile):
+            return []
+        with open(self.profileFile) as f:
+            return json.load(f)
+
+    def getSummary(self):
+        """ One line summary of the time spent in external programs and Python code """
+        records = self.getRecords()
+        if not records:
+            return None
+        wallTimes = {'binary': 0.0, 'python': 0.0}
+        for record in records:
+            wallTimes[record['kind']] = wallTimes.get(record['kind'], 0.0) + record['wallTime']
+        total = sum(wallTimes.values())
+        peakRss = max([max(r.get('processPeakRssMB', 0), r.get('childProcessPeakRssMB', 0)) for r in records])
+        return 'Profile: {:.1f} s in profiled sections, {:.1f} s ({:.0f}%) running fpocket/mdpocket and {:.1f} s in ' \
+               'Python processing. Peak RSS {:.1f} MB (see {})'.\
+            format(total, wallTimes['binary'], 100 * wallTimes['binary'] / total if total else 0,
+                   wallTimes['python'], peakRss, os.path.basename(self.profileFile))
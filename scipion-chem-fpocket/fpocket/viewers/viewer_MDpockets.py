@@ -31,6 +31,8 @@ import pyworkflow.viewer as pwviewer
 
 
 from ..protocols import MDpocketCharacterize
+from ..constants import MDPOCKET_DESCRIPTORS, DESCRIPTOR_PLOT_BINS
+from ..utils import getDescriptorNames, readDescriptorColumn, getDescriptorReduction
 import pyworkflow.protocol.params as params
 from pwchem.viewers import  PyMolView
 from pwchem.utils import natural_sort
@@ -106,8 +108,7 @@ class viewerMDPocket(pwviewer.ProtocolViewer):
     load {}
     
     '''
-    pdbFile = self.protocol.inputSystem.get().getSystemFile()
-    trjFile = self.protocol.inputSystem.get().getTrajectoryFile()
+    pdbFile, trjFile = self.protocol.getPocketSystemFiles(self.nPocket.get()+1)
     dir = os.path.abspath(self.protocol._getExtraPath('pocketFolder_{}'.format(str(self.nPocket.get()+1))))
     dynPocket ='{}/mdpout_mdpocket_{}.pdb'.format(dir, str(self.nPocket.get()+1))
     dynAtoms = '{}/mdpout_mdpocket_atoms_{}.pdb'.format(dir, str(self.nPocket.get()+1))
@@ -136,9 +137,9 @@ class viewerMDPocket(pwviewer.ProtocolViewer):
 
   def _showMdVMD(self, paramName=None):
       dir = os.path.abspath(self.protocol._getExtraPath('pocketFolder_{}'.format(str(self.nPocket.get() + 1))))
-      pdbFile = self.protocol.inputSystem.get().getSystemFile()
+      # Same (possibly reduced or cropped) system and trajectory the pocket atoms were computed on
+      pdbFile, trjFile = self.protocol.getPocketSystemFiles(self.nPocket.get() + 1)
       dynAtoms = '{}/mdpout_mdpocket_atoms_{}.pdb'.format(dir, str(self.nPocket.get() + 1))
-      trjFile = self.protocol.inputSystem.get().getTrajectoryFile()
 
       TCL_MD_STR = '''
         mol addrep 0
@@ -179,22 +180,18 @@ class viewerMDPocket(pwviewer.ProtocolViewer):
       dir = os.path.abspath(self.protocol._getExtraPath('pocketFolder_{}'.format(str(self.nPocket.get()+1))))
       descrFile = '{}/mdpout_descriptors_{}.txt'.format(dir, str(self.nPocket.get()+1))
 
-      with open(descrFile, 'r') as fileTxt:
-          desc_dic = {} #dictionary descriptor:value
-          header = fileTxt.readline().split() #create a list with the header of the file
-          for h in header:
-              desc_dic[h] = [] # inicializate the dictionary so we can append the values
-          for line in fileTxt:
-              for i, descriptor in enumerate(line.split()): #take the i (position) and descriptor value in each line of the file
-                  desc_dic[header[i]].append(descriptor) #add to the dictionary the value of each descriptor
-
-
-
-
-      desc_dic_list = list(desc_dic.values())
-      snaps = desc_dic_list[0] #Snapshots are the first element of the list
-      d = self.displayDesc.get()+1 #To start by the second element
-      desctr = list(map(float, desc_dic_list[d]))
+      # Only the snapshots and the selected descriptor columns are loaded (memory mapped) from the columnar store
+      header = getDescriptorNames(descrFile)
+      snaps = readDescriptorColumn(descrFile, header[0]) #Snapshots are the first column
+      descName = MDPOCKET_DESCRIPTORS[self.displayDesc.get()] #Column name of the selected descriptor
+      desctr = readDescriptorColumn(descrFile, descName)
+      if desctr is None:
+          singlePass = self.protocol.getEnumText('characMode') == 'Single pass'
+          return [self.errorMessage('Descriptor "{}" is not available for this pocket.\n{}'
+                                    'Available descriptors: {}'.format(self.getEnumText('displayDesc'),
+                                    'Pockets characterized in single pass mode only have the descriptors derived from '
+                                    'the alpha sphere centers.\n' if singlePass else '', ', '.join(header[1:])),
+                                    title='Missing descriptor')]
 
 
 
@@ -202,9 +199,21 @@ class viewerMDPocket(pwviewer.ProtocolViewer):
       self.plotter = EmPlotter(x = 1, y = 1, windowTitle='Pocket Descriptors')
       a = self.plotter.createSubPlot("Pocket {} ".format(str(self.nPocket.get()+1)), "Snapshots", "Descriptors")
 
-      a.plot(snaps, desctr)
-
-      a.legend(labels=['{}'.format(str(self.getEnumText('displayDesc')))]) #Get the name of the list element  displayed
+      # Long series are drawn reduced to screen resolution (cached next to the descriptors file)
+      descLabel = str(self.getEnumText('displayDesc')) #Get the name of the list element  displayed
+      reduction = getDescriptorReduction(descrFile, descName, nBins=DESCRIPTOR_PLOT_BINS)
+      if len(snaps) <= DESCRIPTOR_PLOT_BINS:
+          a.plot(snaps, desctr, label=descLabel)
+      else:
+          a.fill_between(reduction['x'], reduction['min'], reduction['max'], alpha=0.35, linewidth=0,
+                         label='{} (min/max)'.format(descLabel))
+      if reduction['window'] > 1:
+          a.plot(reduction['x'], reduction['mean'], color='black', linewidth=1,
+                 label='Rolling mean ({} snapshots)'.format(int(reduction['window'])))
+          a.fill_between(reduction['x'], reduction['mean'] - reduction['std'], reduction['mean'] + reduction['std'],
+                         color='grey', alpha=0.3, linewidth=0, label='Rolling std')
+
+      a.legend()
 
       # Formatting the X axis and Y axis for correct values distribution in the axis
       xmajor_formatter = FormatStrFormatter('%1.1f') # 1 space reserved for decimal value
@@ -26,6 +26,8 @@
 import os
 
 from ..protocols import MDpocketAnalyze
+from ..constants import GRID_RESOLUTIONS, GRID_RESOLUTION_FACTORS
+from ..utils import ensureDXGridLevel
 import pyworkflow.protocol.params as params
 from pwchem.viewers import ViewerGeneralPockets
 from pwchem.viewers import VmdViewPopen
@@ -53,6 +55,13 @@ class viewerVolMDPocket(ViewerGeneralPockets):
                  help='*Frequency grid*: measure of how many times the pocket was open during MD trajectory\n'
                       '*Density grid*: Superposition of the alpha spheres of all snapshots along the MD trajectory'
                  )
+    group.addParam('volResolution', params.EnumParam,
+                   choices=GRID_RESOLUTIONS, default=0,
+                   label='Grid resolution:',
+                   help='Resolution of the grid loaded in VMD. The coarse levels keep the maximum of blocks of 4x4x4 '
+                        'or 2x2x2 voxels, so they load much faster and their isosurface at the same isovalue '
+                        'encloses the full resolution one (slightly bigger, but no pocket is missed). '
+                        'The full resolution grid is only loaded when selected.')
 
   def _getVisualizeDict(self):
     visDict = super()._getVisualizeDict()
@@ -66,10 +75,10 @@ class viewerVolMDPocket(ViewerGeneralPockets):
 
   def _showVolFileVMD(self, paramName=None):
 
-    pdbFile = self.protocol.inputSystem.get().getSystemFile()
-    #print('Dens file: ', self.protocol.outputPockets.densVolFile.get())
-    densFile = self.protocol.outputPockets.densVolFile.get()
-    freqFile = self.protocol.outputPockets.freqVolFile.get()
+    pdbFile = self.protocol.getStagedSystemFile()
+    # DX paths of the grids, which may only be stored in their sparse version (see ensureDXGridLevel below)
+    densFile = self.protocol.getDensGridFile()
+    freqFile = self.protocol.getFreqGridFile()
 
 
     TCL_MD_STR = '''
@@ -99,6 +108,9 @@ class viewerVolMDPocket(ViewerGeneralPockets):
     elif volFile == 'Density grid file':
         gridFile = densFile
 
+    # The DX grid of the selected resolution is exported from its sparse version if needed (the full resolution DX
+    # files are removed once compressed unless they are kept)
+    gridFile = ensureDXGridLevel(gridFile, GRID_RESOLUTION_FACTORS[self.volResolution.get()])
     with open(outTcl, 'w') as f:
       f.write(TCL_MD_STR % (gridFile, pdbFile))
     args = '-e {}'.format(outTcl)